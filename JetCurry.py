@@ -17,15 +17,30 @@ import numpy as np
 import math
 from pylab import *
 from matplotlib import *
-from scipy.interpolate import spline
+from scipy.interpolate import make_interp_spline
+import os
+import time
+import logging
+import cProfile
 import emcee
+import JetCurryObjective as objective
+import JetCurryQueue
+import JetCurryMetrics
+import JetCurryLogger
 from scipy.optimize import fmin_l_bfgs_b
-from multiprocessing import Process
+from multiprocessing import Pool, cpu_count
 import warnings
 warnings.filterwarnings("ignore")
 
 np.seterr(all='ignore')
 
+# Messages of the per-sample tasks, see JetCurryLogger.attach_worker
+_log = logging.getLogger(JetCurryLogger.WORKER_LOGGER)
+
+# Statistics of the task running in this process, filled in by the
+# solvers and collected by Run_Measured
+_TASK_STATS = {}
+
 def imagesqrt(image, scale_min, scale_max):
     '''
     Algorithm Courtesy of Min-Su Shin (msshin @ umich.edu)
@@ -54,7 +69,42 @@ def imagesqrt(image, scale_min, scale_max):
     return imageData
 
 
-def Find_MaxFlux(file1, Upstream_Bounds, Downstream_Bounds, number_of_points):
+def Smooth_Ridge(x, y, x_smooth, smoothing=None):
+    '''
+    Spline through the ridge, evaluated at x_smooth. Points with a NaN
+    y are left out. Both splines are B-splines fitted with banded
+    solvers, so the time grows linearly with the length of the ridge.
+
+    Arguments:
+        x, y : numpy array
+            Ridge points, x increasing
+        x_smooth : numpy array
+            Positions to evaluate the spline at
+        smoothing : float
+            None for a cubic spline through every point, otherwise the
+            penalty lam of scipy.interpolate.make_smoothing_spline; larger
+            values give a smoother ridge
+
+    Returns:
+        y_smooth : numpy array
+            NaN everywhere if no point has data
+    '''
+    keep = np.isfinite(y)
+    x = np.asarray(x, dtype=float)[keep]
+    y = np.asarray(y, dtype=float)[keep]
+    if len(x) == 0:
+        return np.full(len(x_smooth), np.nan)
+    if len(x) == 1:
+        return np.full(len(x_smooth), y[0])
+    # make_smoothing_spline needs at least 5 points
+    if smoothing is not None and len(x) >= 5:
+        from scipy.interpolate import make_smoothing_spline
+        return make_smoothing_spline(x, y, lam=smoothing)(x_smooth)
+    return make_interp_spline(x, y, k=min(3, len(x) - 1))(x_smooth)
+
+
+def Find_MaxFlux(file1, Upstream_Bounds, Downstream_Bounds, number_of_points,
+                 smoothing=None):
     '''
     Calculates the max along each column
 
@@ -67,43 +117,47 @@ def Find_MaxFlux(file1, Upstream_Bounds, Downstream_Bounds, number_of_points):
             End position of jet
         number_of_points : numpy integer
             Number of pixels along x-axis of the start and end positions of jet
+        smoothing : float
+            Smoothing of the ridge, see Smooth_Ridge
 
     Returns:
         intensity_xpos : numpy array
             Max intensity at point x
         intensity_ypos : numpy array
-            Max intensity at point y
+            Max intensity at point y, NaN for columns without data
         x_smooth : numpy array
             Returns number_of_points evenly spaced samples
                 calculated over the start/stop interval
         y_smooth : numpy array
             Interpolate a curve using spline fit
         intensity_max : numpy array
-            Max intensity of each column
-    '''
-    height, width = file1.shape
-    intensity_max = np.array([])
-    intensity_ypos = np.array([])
-    intensity_xpos = np.array([])
-    temp = np.zeros(shape=(height, 1))
-    for k in range(Upstream_Bounds[0], Downstream_Bounds[0] - 1):
-        for j in range(0, height - 1):
-            pixel = file1[j, k]
-            temp[j] = pixel
-        pixel_max = np.nanmax(temp)
-        position = [i for i, j in enumerate(temp) if j == pixel_max]
-        intensity_max = np.append(intensity_max, pixel_max)
-        intensity_ypos = np.append(intensity_ypos, position[0])
-        intensity_xpos = np.append(intensity_xpos, k)
+            Max intensity of each column, NaN for columns without data
+    '''
+    # Columns from the upstream bound up to, but not including, the
+    # downstream bound. NaN pixels never win the argmax and columns
+    # without any data give NaN.
+    columns = np.asarray(
+        file1[:, Upstream_Bounds[0]:Downstream_Bounds[0]], dtype=float)
+    missing = np.isnan(columns)
+    has_data = ~missing.all(axis=0)
+    rows = np.argmax(np.where(missing, -np.inf, columns), axis=0)
+    intensity_max = columns[rows, np.arange(columns.shape[1])]
+    intensity_ypos = rows.astype(float)
+    intensity_max[~has_data] = np.nan
+    intensity_ypos[~has_data] = np.nan
+    intensity_xpos = np.arange(
+        Upstream_Bounds[0], Downstream_Bounds[0], dtype=float)
     x_smooth = np.linspace(
         Upstream_Bounds[0],
         Downstream_Bounds[0],
         num=number_of_points)
-    y_smooth = spline(intensity_xpos, intensity_ypos, x_smooth)
+    y_smooth = Smooth_Ridge(intensity_xpos, intensity_ypos, x_smooth,
+                            smoothing)
     return intensity_xpos, intensity_ypos, x_smooth, y_smooth, intensity_max
 
 
-def Calculate_s_and_eta(x_smooth, y_smooth, core_points, output_directory, filename):
+def Calculate_s_and_eta(x_smooth, y_smooth, core_points,
+                        output_directory=None, filename=None):
     '''
     Calculates S and ETA values
 
@@ -115,354 +169,963 @@ def Calculate_s_and_eta(x_smooth, y_smooth, core_points, output_directory, filen
         core_points : numpy array
             Start position of jet
         output_directory : string
-            Path of location to save data products
+            Optional path of location to save data products. If given,
+            the values are also written with Write_Parameters
         filename : string
             Root name of file to be saved
 
     Returns:
-        s: list
-        eta: list
-    '''
-    s = []
-    eta = []
-
-    for i in range(len(x_smooth)):
-        x = x_smooth[i] - float(core_points[1])  # default core_points[1]
-        y = y_smooth[i] - float(core_points[0])  # default core_points[0]
-        s_value = (x**2 + y**2)**(0.5)
-        eta_value = math.atan(y / x)
-        s.append(s_value)
-        eta.append(eta_value)
-
-    with open(output_directory + filename + '_parameters.txt', 'w') as file:
-        for x in range(len(x_smooth)):
-            file.write(str(s[x]) + '\t' + str(eta[x]) + '\t' +
-                       str(x_smooth[x]) + '\t' + str(y_smooth[x]) + '\n')
+        s : numpy array
+            Projected distance of each sample from the core
+        eta : numpy array
+            Projected angle of each sample, from arctan2 so that it is
+            in the right quadrant on either side of the core
+    '''
+    x = np.asarray(x_smooth, dtype=float) - float(core_points[1])  # default core_points[1]
+    y = np.asarray(y_smooth, dtype=float) - float(core_points[0])  # default core_points[0]
+    s = np.hypot(x, y)
+    eta = np.arctan2(y, x)
+    if output_directory is not None:
+        Write_Parameters(s, eta, x_smooth, y_smooth, output_directory, filename)
     return s, eta
 
 
-def Run_MCMC1(s, eta, theta, ind, output_directory, filename):
-    '''
-    '''
-    ndim, nwalkers, nsteps = 5, 1024, 50
-    initial_alpha = np.arange(0, 2.0, 0.5)
-    initial_beta = np.arange(0, 2.0, 0.5)
-    initial_phi = np.arange(0, 2.0, 0.5)
-    initial_xi = np.arange(0, 2.0, 0.5)
-    initial_d = np.arange(floor(s), floor(s) + 4 * 20.25, 20.25)
-    pos = []
-    for i in range(len(initial_alpha)):
-        for j in range(len(initial_beta)):
-            for k in range(len(initial_phi)):
-                for l in range(len(initial_xi)):
-                    for m in range(len(initial_d)):
-                        init = []
-                        init.append(initial_alpha[i])
-                        init.append(initial_beta[j])
-                        init.append(initial_phi[k])
-                        init.append(initial_xi[l])
-                        init.append(initial_d[m])
-                        pos.append(init)
-
-    def lnlike(v):
-        '''
-        '''
-        alpha, beta, phi, xi, d = v
-        model = (((s * np.sin(eta)) / np.sin(phi))**2 + (s * np.cos(eta) * (np.sin(theta) * np.cos(alpha) + np.sin(alpha) * np.cos(theta)) / np.cos(alpha))**2 - d**2)**2 + (((np.sin(beta) * np.cos(alpha)) / (np.sin(alpha) * np.cos(beta)))**2 - (np.cos(eta)**2))**2 + (d * np.cos(xi) * np.cos(theta) - ((s * np.cos(eta) * np.sin(alpha)) / np.cos(alpha)) - d * np.sin(xi) * np.cos(phi) * np.sin(theta))**2 + ((np.sin(eta) / np.cos(eta)) - ((np.sin(xi) * np.sin(phi)) / (np.cos(xi) * np.sin(theta) + np.sin(xi) * np.cos(phi) * np.cos(theta))))**2 + (s - d * np.cos(beta))**2
-        return -np.log(np.abs(model) + 1)
+def Write_Parameters(s, eta, x_smooth, y_smooth, output_directory, filename):
+    '''
+    Writes one tab separated s, eta, x_smooth, y_smooth line per sample
+    to <filename>_parameters.txt
+    '''
+    np.savetxt(output_directory + filename + '_parameters.txt',
+               np.column_stack([s, eta, x_smooth, y_smooth]),
+               fmt='%s', delimiter='\t')
 
-    t = 1.5708 - theta
 
-    def lnprior(v):
-        '''
-        '''
-        alpha, beta, phi, xi, d = v
-        if 0 < alpha < 1.57 and 0 < beta < 1.57 and 0 < phi < 3.14 and 0 < xi < t and floor(s) < d < floor(s) + 3 * 20.25:
-            return 0.0
-        return np.inf
+# Adaptive stopping of the MCMC stages, see _Run_Sampler. The sampler
+# runs in chunks of 'chunk' steps and stops once the best log-probability
+# improved by less than 'tolerance' over the last 'patience' chunks, and
+# never runs more than 'max_steps' steps. A chain can only pass emcee's
+# autocorrelation convergence test (see _Converged) once it is 50
+# autocorrelation times long, which takes a 'max_steps' well above the
+# default.
+ADAPTIVE_SETTINGS = {'chunk': 10, 'patience': 2, 'tolerance': 1e-3,
+                     'max_steps': 50}
 
-    def lnprob(v):
-        '''
-        '''
-        lp = lnprior(v)
-        if not np.isfinite(lp):
-            return -np.inf
-        return lp + lnlike(v)
-
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob)
-    sampler.run_mcmc(pos, nsteps)
-    samples = sampler.flatchain
-    probs = sampler.flatlnprobability
-    A = np.array(probs)
-    maximum_indices = np.where(A == max(probs))
-    pvectors = []
-    pvectors = samples[maximum_indices]
-    r = pvectors[0]
-
-    with open(output_directory + filename + '_MCMC1.txt', 'a') as file:
-        file.write(str(r[0]) +
-                   '\t' +
-                   str(r[1]) +
-                   '\t' +
-                   str(r[2]) +
-                   '\t' +
-                   str(r[3]) +
-                   '\t' +
-                   str(r[4]) +
-                   '\t' +
-                   str(ind) +
-                   '\n')
-    return
-
-
-def MCMC1_Parallel(s, eta, theta, output_directory, filename):
-    '''
-    '''
-    for i in range(0, int(len(s) - 3.0), 4):
-        r = Process(target=Run_MCMC1, args=(s[i], eta[i], theta, i, output_directory, filename))
-        r.start()
-        r.join()
-
-        r1 = Process(target=Run_MCMC1, args=(
-            s[i + 1], eta[i + 1], theta, i + 1, output_directory, filename))
-        r1.start()
-        r1.join()
-
-        r2 = Process(target=Run_MCMC1, args=(
-            s[i + 2], eta[i + 2], theta, i + 2, output_directory, filename))
-        r2.start()
-        r2.join()
-
-        r3 = Process(target=Run_MCMC1, args=(
-            s[i + 3], eta[i + 3], theta, i + 3, output_directory, filename))
-        r3.start()
-        r3.join()
-
-    return
-
-
-def RunMCMC2(s, eta, d0, theta, a, b, c, e, ind, output_directory, filename):
-    '''
-    '''
-    initial_alpha = np.arange(a, a + 0.2, 0.05)
-    initial_beta = np.arange(b, b + 0.2, 0.05)
-    initial_phi = np.arange(c, c + 0.2, 0.05)
-    initial_xi = np.arange(e, e + 0.2, 0.05)
-    initial_d = np.arange(floor(d0), floor(d0) + 2.0, 0.5)
-
-    pos = []
-    for i in range(len(initial_alpha)):
-        for j in range(len(initial_beta)):
-            for k in range(len(initial_phi)):
-                for l in range(len(initial_xi)):
-                    for m in range(len(initial_d)):
-                        init = []
-                        init.append(initial_alpha[i])
-                        init.append(initial_beta[j])
-                        init.append(initial_phi[k])
-                        init.append(initial_xi[l])
-                        init.append(initial_d[m])
-                        pos.append(init)
-
-    ndim, nwalkers, nsteps = 5, int(shape(pos)[0]), 50
-
-    def lnlike(v):
-        '''
-        '''
-        alpha, beta, phi, xi, d = v
-        model = (((s * np.sin(eta)) / np.sin(phi))**2 + (s * np.cos(eta) * (np.sin(theta) * np.cos(alpha) + np.sin(alpha) * np.cos(theta)) / np.cos(alpha))**2 - d**2)**2 + (((np.sin(beta) * np.cos(alpha)) / (np.sin(alpha) * np.cos(beta)))**2 - (np.cos(eta)**2))**2 + (d * np.cos(xi) * np.cos(theta) - ((s * np.cos(eta) * np.sin(alpha)) / np.cos(alpha)) - d * np.sin(xi) * np.cos(phi) * np.sin(theta))**2 + ((np.sin(eta) / np.cos(eta)) - ((np.sin(xi) * np.sin(phi)) / (np.cos(xi) * np.sin(theta) + np.sin(xi) * np.cos(phi) * np.cos(theta))))**2 + (s - d * np.cos(beta))**2
-        return -np.log(np.abs(model) + 1)
+# Steps of the MCMC stages when adaptive stopping is off
+NSTEPS = 50
 
-    t = 1.5708 - theta
 
-    def lnprior(v):
-        '''
-        '''
-        alpha, beta, phi, xi, d = v
-        if a < alpha < (
-                a +
-                0.2) and b < beta < (
-                b +
-                0.2) and c < phi < (
-                c +
-                0.2) and e < xi < (
-                    e +
-                    0.2) and floor(d0) < d < (
-                        floor(d0) +
-                        3 *
-                20.25):
-            return 0.0
-        return np.inf
-
-    def lnprob(v):
+def _Converged(means, tau_old):
+    '''
+    emcee's convergence test: the chain is longer than 50 integrated
+    autocorrelation times and the estimate changed by less than 1%.
+    tau is estimated from the ensemble mean of every step, (steps, 5),
+    which is much cheaper than averaging over a thousand walkers and is
+    only used to decide when to stop.
+
+    Returns:
+        converged : bool
+        tau : numpy array
+            Estimate for the next call
+    '''
+    tau = emcee.autocorr.integrated_time(means[:, None, :], tol=0)
+    converged = (np.all(np.isfinite(tau)) and np.all(len(means) > 50 * tau)
+                 and np.all(np.abs(tau_old - tau) < 0.01 * tau))
+    return converged, tau
+
+
+# Posterior draws of the MCMC2 stage, see _Posterior_Draws. After the
+# first 'burn' steps every 'thin'-th step is kept, and 'draws' of the
+# kept walker positions, chosen uniformly by reservoir sampling, are
+# stored per sample point.
+POSTERIOR_SETTINGS = {'burn': 10, 'thin': 5, 'draws': 256}
+
+
+def Create_Posterior(path, samples, draws=POSTERIOR_SETTINGS['draws']):
+    '''
+    Creates the posterior store, an .npy file of (samples, draws, 5)
+    float32 vectors that are NaN until written by Write_Posterior. The
+    draws come back with the sample results, which the checkpoint
+    keeps, so a resumed run fills in the store again.
+    '''
+    shape = (samples, draws, len(PARAMETERS))
+    store = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                      shape=shape)
+    store[:] = np.nan
+    store.flush()
+
+
+class _Posterior_Draws():
+    '''
+    Draws of one sample point, kept in memory as the sampler runs and
+    returned with its result, see Write_Posterior
+
+    Arguments:
+        posterior : dict
+            Settings overriding POSTERIOR_SETTINGS
+    '''
+
+    def __init__(self, posterior):
+        settings = dict(POSTERIOR_SETTINGS)
+        settings.update(posterior)
+        self.burn = settings['burn']
+        self.thin = max(1, settings['thin'])
+        self.row = np.full((settings['draws'], len(PARAMETERS)), np.nan)
+        self.seen = 0
+
+    def add(self, step, coords):
         '''
+        Offers the walker positions of step (counted from 1)
         '''
-        lp = lnprior(v)
-        if not np.isfinite(lp):
-            return -np.inf
-        return lp + lnlike(v)
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob)
-    sampler.run_mcmc(pos, nsteps)
-    samples = sampler.flatchain
-    probs = sampler.flatlnprobability
-    A = np.array(probs)
-    maximum_indices = np.where(A == max(probs))
-    pvectors = []
-    pvectors = samples[maximum_indices]
-    h = pvectors[0]
-
-    with open(output_directory + filename + '_MCMC2.txt', 'a') as file:
-        file.write(str(h[0]) +
-                   '\t' +
-                   str(h[1]) +
-                   '\t' +
-                   str(h[2]) +
-                   '\t' +
-                   str(h[3]) +
-                   '\t' +
-                   str(h[4]) +
-                   '\t' +
-                   str(ind) +
-                   '\n')
-    return
-
-
-def MCMC2_Parallel(s, eta, theta, output_directory, filename):
-    '''
-    '''
-    alpha_first = []
-    beta_first = []
-    phi_first = []
-    xi_first = []
-    d_first = []
-    for line in open(output_directory + filename + '_MCMC1.txt', 'r').readlines():
-        if line.startswith('#'):
+        if step <= self.burn or (step - self.burn) % self.thin:
+            return
+        seen = self.seen + np.arange(len(coords))
+        self.seen += len(coords)
+        # The first len(row) positions fill the row, each later one
+        # replaces a random draw with probability len(row) / (seen + 1)
+        slots = np.where(seen < len(self.row), seen,
+                         (np.random.uniform(size=len(coords)) *
+                          (seen + 1)).astype(int))
+        keep = slots < len(self.row)
+        self.row[slots[keep]] = coords[keep]
+
+
+def Write_Posterior(path, samples, results):
+    '''
+    Writes the posterior draws returned by the sample tasks to their
+    rows of the store made by Create_Posterior. Only the process that
+    runs the stage writes the store, never the workers, which with
+    -queue may be on other machines.
+
+    Arguments:
+        path : string
+            Posterior store
+        samples : numpy array
+            Row of each result
+        results : list of numpy arrays
+            Sample results, the draws following the first 6 values
+    '''
+    store = np.load(path, mmap_mode='r+')
+    for j, result in zip(samples, results):
+        if len(result) > 6:
+            store[j] = np.reshape(result[6:], store.shape[1:])
+    store.flush()
+    del store
+
+
+class _Acceptance_Backend(emcee.backends.Backend):
+    '''
+    emcee backend that keeps no chain, only the number of accepted
+    proposals of every walker and the number of steps, so that the
+    sampler's acceptance_fraction is right
+    '''
+
+    def grow(self, ngrow, blobs):
+        pass
+
+    def save_step(self, state, accepted):
+        self.accepted += accepted
+        self.random_state = state.random_state
+        self.iteration += 1
+
+
+def _Run_Sampler(pos, constants, lower, upper, adaptive=None,
+                 posterior=None):
+    '''
+    Runs an emcee ensemble inside the prior box (lower, upper). The
+    chain is not kept in memory, only the best position so far.
+
+    Arguments:
+        pos : numpy array
+            (nwalkers, 5) starting positions
+        constants : numpy array
+            Output of objective.Sample_Constants
+        lower, upper : numpy array
+            Prior box
+        adaptive : dict
+            None for a fixed run of NSTEPS steps, otherwise settings
+            overriding ADAPTIVE_SETTINGS
+        posterior : dict
+            Optional settings of the posterior draws, see
+            _Posterior_Draws
+
+    Returns:
+        numpy array
+            Highest probability [alpha, beta, phi, xi, d] vector followed
+            by the number of steps run and, with posterior, the
+            flattened (draws, 5) posterior draws
+    '''
+    nwalkers, ndim = pos.shape
+    sampler = emcee.EnsembleSampler(
+        nwalkers, ndim, objective.Log_Probability,
+        args=(constants, lower, upper), vectorize=True,
+        backend=_Acceptance_Backend())
+    max_steps = NSTEPS
+    if adaptive is not None:
+        settings = dict(ADAPTIVE_SETTINGS)
+        settings.update(adaptive)
+        max_steps = settings['max_steps']
+    if max_steps < 1:
+        raise ValueError('max_steps must be at least 1, not %s' % max_steps)
+    draws = None
+    if posterior is not None:
+        draws = _Posterior_Draws(posterior)
+
+    best_vector, best_value = None, -np.inf
+    # Best log-probability at the end of every chunk and ensemble mean
+    # of every step, for adaptive stopping
+    best, means = [], []
+    tau = np.inf
+    steps = 0
+    for state in sampler.sample(pos, iterations=max_steps):
+        steps += 1
+        i = np.argmax(state.log_prob)
+        if best_vector is None or state.log_prob[i] > best_value:
+            best_vector, best_value = state.coords[i].copy(), state.log_prob[i]
+        if draws is not None:
+            draws.add(steps, state.coords)
+        if adaptive is None:
             continue
-        # if line.startswith('\n'):
-        #    continue
-        fields = line.split()
-        alpha_first.append(fields[0])
-        beta_first.append(fields[1])
-        phi_first.append(fields[2])
-        xi_first.append(fields[3])
-        d_first.append(fields[4])
-    alpha_first = [float(i) for i in alpha_first]
-    beta_first = [float(i) for i in beta_first]
-    phi_first = [float(i) for i in phi_first]
-    xi_first = [float(i) for i in xi_first]
-    d_first = [float(i) for i in d_first]
-    for j in range(0, len(alpha_first), 4):
-        alpha0 = float(alpha_first[j])
-        beta0 = float(beta_first[j])
-        phi0 = float(phi_first[j])
-        xi0 = float(xi_first[j])
-        d0 = float(d_first[j])
-        a = float(0.1 * (floor(10 * alpha0)))
-        b = float(0.1 * floor(10 * beta0))
-        c = float(0.1 * floor(10 * phi0))
-        e = float(0.1 * floor(10 * xi0))
-        h = Process(
-            target=RunMCMC2,
-            args=(
-                s[j],
-                eta[j],
-                d0,
-                theta,
-                a,
-                b,
-                c,
-                e,
-                j, output_directory, filename))
-        h.start()
-        h.join()
-        alpha1 = float(alpha_first[j + 1])
-        beta1 = float(beta_first[j + 1])
-        phi1 = float(phi_first[j + 1])
-        xi1 = float(xi_first[j + 1])
-        d1 = float(d_first[j + 1])
-        a1 = float(0.1 * (floor(10 * alpha1)))
-        b1 = float(0.1 * floor(10 * beta1))
-        c1 = float(0.1 * floor(10 * phi1))
-        e1 = float(0.1 * floor(10 * xi1))
-        h1 = Process(target=RunMCMC2, args=(
-            s[j + 1], eta[j + 1], d1, theta, a1, b1, c1, e1, j + 1, output_directory, filename))
-        h1.start()
-        h1.join()
-        alpha2 = float(alpha_first[j + 2])
-        beta2 = float(beta_first[j + 2])
-        phi2 = float(phi_first[j + 2])
-        xi2 = float(xi_first[j + 2])
-        d2 = float(d_first[j + 2])
-        a2 = float(0.1 * (floor(10 * alpha2)))
-        b2 = float(0.1 * floor(10 * beta2))
-        c2 = float(0.1 * floor(10 * phi2))
-        e2 = float(0.1 * floor(10 * xi2))
-        h2 = Process(target=RunMCMC2, args=(
-            s[j + 2], eta[j + 2], d2, theta, a2, b2, c2, e2, j + 2, output_directory, filename))
-        h2.start()
-        h2.join()
-        alpha3 = float(alpha_first[j + 3])
-        beta3 = float(beta_first[j + 3])
-        phi3 = float(phi_first[j + 3])
-        xi3 = float(xi_first[j + 3])
-        d3 = float(d_first[j + 3])
-        a3 = float(0.1 * (floor(10 * alpha3)))
-        b3 = float(0.1 * floor(10 * beta3))
-        c3 = float(0.1 * floor(10 * phi3))
-        e3 = float(0.1 * floor(10 * xi3))
-        h3 = Process(target=RunMCMC2, args=(
-            s[j + 3], eta[j + 3], d3, theta, a3, b3, c3, e3, j + 3, output_directory, filename))
-        h3.start()
-        h3.join()
-    return
-
-def Annealing1(eta, s, theta, alpha0, beta0, phi0, xi0, d0, a, b, c, e, ind, output_directory, filename):
-    '''
-    '''
-
-    def f(x):
-        '''
-        '''
-        alpha, beta, phi, xi, d = x
-        return ((((s *
-                   np.sin(eta)) /
-                  np.sin(phi))**2 +
-                 (s *
-                  np.cos(eta) *
-                  (np.sin(theta) *
-                   np.cos(alpha) +
-                   np.sin(alpha) *
-                   np.cos(theta)) /
-                  np.cos(alpha))**2 -
-                 d**2)**2 +
-                (((np.sin(beta) *
-                   np.cos(alpha)) /
-                  (np.sin(alpha) *
-                   np.cos(beta)))**2 -
-                 (np.cos(eta)**2))**2 +
-                (d *
-                 np.cos(xi) *
-                 np.cos(theta) -
-                 ((s *
-                   np.cos(eta) *
-                   np.sin(alpha)) /
-                  np.cos(alpha)) -
-                 d *
-                 np.sin(xi) *
-                 np.cos(phi) *
-                 np.sin(theta))**2 +
-                ((np.sin(eta) /
-                  np.cos(eta)) -
-                 ((np.sin(xi) *
-                   np.sin(phi)) /
-                    (np.cos(xi) *
-                     np.sin(theta) +
-                     np.sin(xi) *
-                     np.cos(phi) *
-                     np.cos(theta))))**2 +
-                (s -
-                 d *
-                 np.cos(beta))**2)
+        means.append(np.mean(state.coords, axis=0))
+        if steps % settings['chunk'] and steps < max_steps:
+            continue
+        best.append(best_value)
+        patience = settings['patience']
+        if (len(best) > patience and
+                best[-1] - best[-1 - patience] < settings['tolerance']):
+            break
+        converged, tau = _Converged(np.array(means), tau)
+        if converged:
+            break
+    if adaptive is not None and steps >= max_steps:
+        _log.debug('Adaptive MCMC stopped at max_steps=%d, best '
+                   'log-probability %.6g', max_steps, best_value)
+    _TASK_STATS.setdefault('acceptance', []).append(
+        float(np.mean(sampler.acceptance_fraction)))
+    result = np.append(best_vector, steps)
+    if draws is not None:
+        result = np.append(result, draws.row)
+    return result
+
+
+# Seeding of the MCMC stages, see Seed_Walkers. 'points' are evaluated
+# in the prior box and the best 'walkers' of them start the ensemble.
+SEED_SETTINGS = {'points': 8192, 'walkers': 128}
+
+
+def _Grid(*axes):
+    '''
+    Every combination of the axis values as an (n, len(axes)) array,
+    with the last axis varying fastest
+    '''
+    return np.stack(np.meshgrid(*axes, indexing='ij'),
+                    axis=-1).reshape(-1, len(axes))
+
+
+def Seed_Walkers(constants, lower, upper, seed=None):
+    '''
+    Starting walkers taken from the best points of a Latin hypercube
+    in the prior box. All points are evaluated in a single vectorized
+    call of the objective.
+
+    Arguments:
+        constants : numpy array
+            Output of objective.Sample_Constants
+        lower, upper : numpy array
+            Prior box
+        seed : dict
+            Settings overriding SEED_SETTINGS
+
+    Returns:
+        numpy array
+            (walkers, 5) starting positions
+    '''
+    settings = dict(SEED_SETTINGS)
+    if seed is not None:
+        settings.update(seed)
+    n, ndim = settings['points'], len(lower)
+    # One point per stratum of every axis, paired at random between axes
+    strata = np.argsort(np.random.uniform(size=(ndim, n)), axis=1).T
+    u = (strata + np.random.uniform(size=(n, ndim))) / n
+    points = lower + u * (upper - lower)
+    values = objective.Objective(points, constants)
+    values[~np.isfinite(values)] = np.inf
+    best = np.argpartition(values, settings['walkers'] - 1)
+    return points[best[:settings['walkers']]]
+
+
+def _MCMC1_Box(s, theta):
+    '''
+    Prior box (lower, upper) of the broad search of a sample point
+    '''
+    t = 1.5708 - theta
+    lower = np.array([0, 0, 0, 0, floor(s)])
+    upper = np.array([1.57, 1.57, 3.14, t, floor(s) + 3 * 20.25])
+    return lower, upper
+
+
+def Run_MCMC1(s, eta, theta, adaptive=None, seed=None, posterior=None):
+    '''
+    Broad MCMC search for the jet geometry of one sample point
+
+    Arguments:
+        s : float
+            Projected distance of the sample point from the core
+        eta : float
+            Projected angle of the sample point
+        theta : float
+            Line of sight angle (radians)
+        adaptive : dict
+            Adaptive stopping settings, see _Run_Sampler. None runs a
+            fixed number of steps
+        seed : dict
+            Seeding settings, see Seed_Walkers. None starts 1024 walkers
+            from a fixed grid
+        posterior : dict
+            Optional settings of the posterior draws, see _Posterior_Draws
+
+    Returns:
+        numpy array
+            Highest probability [alpha, beta, phi, xi, d] vector followed
+            by the number of steps run
+    '''
+    lower, upper = _MCMC1_Box(s, theta)
+    constants = objective.Sample_Constants(s, eta, theta)
+
+    if seed is not None:
+        pos = Seed_Walkers(constants, lower, upper, seed)
+    else:
+        angles = np.arange(0, 2.0, 0.5)
+        pos = _Grid(angles, angles, angles, angles,
+                    np.arange(floor(s), floor(s) + 4 * 20.25, 20.25))
+    return _Run_Sampler(pos, constants, lower, upper, adaptive, posterior)
+
+
+# Warm-start of the broad search along the jet, see Run_Warm_Chain.
+# Samples are solved in chains of 'length' consecutive samples. The
+# first sample of a chain (its anchor) gets the full Run_MCMC1 search,
+# every following sample a narrow search of 'walkers' walkers, seeded
+# from 'points' hypercube points, within 'width' of the previous
+# sample's solution. A narrow fit whose objective is above 'fallback'
+# times that of the previous sample (and above 1) is searched again
+# in full. RunMCMC2 then runs the same compact ensemble within 'width'
+# of the sample's own Run_MCMC1 solution.
+WARM_SETTINGS = {'length': 20, 'width': [0.1, 0.1, 0.1, 0.1, 3.0],
+                 'points': 1024, 'walkers': 32, 'fallback': 2.0}
+
+
+def _Warm_Start(constants, lower, upper, center, warm=None):
+    '''
+    Compact ensemble of a warm-started search
+
+    Arguments:
+        constants : numpy array
+            Output of objective.Sample_Constants
+        lower, upper : numpy array
+            Prior box of the search
+        center : numpy array
+            Vector the narrow box is centred on
+        warm : dict
+            Settings overriding WARM_SETTINGS
+
+    Returns:
+        pos, lower, upper : numpy array
+            Starting positions and the narrow box, within 'width' of
+            center and inside the prior box. None if the two boxes do
+            not overlap.
+    '''
+    settings = dict(WARM_SETTINGS)
+    if warm is not None:
+        settings.update(warm)
+    lower = np.maximum(lower, center[:5] - settings['width'])
+    upper = np.minimum(upper, center[:5] + settings['width'])
+    if np.any(upper <= lower):
+        return None
+    pos = Seed_Walkers(constants, lower, upper,
+                       {'points': settings['points'],
+                        'walkers': settings['walkers']})
+    return pos, lower, upper
+
+
+def Run_MCMC_Warm(s, eta, theta, previous, adaptive=None, seed=None,
+                  warm=None, posterior=None):
+    '''
+    Narrow MCMC search around the solution of the neighbouring sample
+    point. Falls back to Run_MCMC1 if the narrow box lies outside the
+    prior box.
+
+    Arguments:
+        s, eta, theta : float
+            See Run_MCMC1
+        previous : numpy array
+            Solution of the previous sample point
+        adaptive : dict
+            See Run_MCMC1
+        seed : dict
+            Seeding settings of the Run_MCMC1 fallback
+        warm : dict
+            Settings overriding WARM_SETTINGS
+        posterior : dict
+            See Run_MCMC1
+
+    Returns:
+        numpy array
+            See Run_MCMC1
+    '''
+    constants = objective.Sample_Constants(s, eta, theta)
+    lower, upper = _MCMC1_Box(s, theta)
+    start = _Warm_Start(constants, lower, upper, previous, warm)
+    if start is None:
+        return Run_MCMC1(s, eta, theta, adaptive, seed, posterior)
+    return _Run_Sampler(start[0], constants, start[1], start[2], adaptive,
+                        posterior)
+
+
+def _Search_Near(s, eta, theta, guess, reference, full, adaptive=None,
+                 seed=None, warm=None, posterior=None):
+    '''
+    Run_MCMC_Warm around guess. If its objective is above 'fallback'
+    times reference (and above 1), full(s, eta, theta, adaptive, seed)
+    is run as well and the better of the two results is kept. With
+    posterior, the draws are those of the search whose result is kept.
+
+    Returns:
+        result : numpy array
+            See Run_MCMC1. The steps include those of both searches.
+        value : float
+            Objective of the result
+    '''
+    settings = dict(WARM_SETTINGS)
+    if warm is not None:
+        settings.update(warm)
+    constants = objective.Sample_Constants(s, eta, theta)
+    result = Run_MCMC_Warm(s, eta, theta, guess, adaptive, seed, warm,
+                           posterior)
+    value = objective.Objective(result[:5], constants)
+    if not value <= max(1.0, settings['fallback'] * reference):
+        _log.info('Warm start at s=%.4g gave objective %.4g, '
+                  'running the full search', s, value)
+        full_result = full(s, eta, theta, adaptive, seed, posterior)
+        full_value = objective.Objective(full_result[:5], constants)
+        steps = result[5] + full_result[5]
+        if full_value < value or not np.isfinite(value):
+            result, value = full_result, full_value
+        result = result.copy()
+        result[5] = steps
+    return result, value
+
+
+def Run_Warm_Chain(s, eta, theta, adaptive=None, seed=None, warm=None):
+    '''
+    Broad search of a run of consecutive sample points, each seeded
+    from the solution of the one before
+
+    Arguments:
+        s, eta : numpy array
+            Sample points of the chain, in order along the jet
+        theta : float
+            Line of sight angle (radians)
+        adaptive, seed : dict
+            Settings of the anchor's full search, see Run_MCMC1
+        warm : dict
+            Settings overriding WARM_SETTINGS
+
+    Returns:
+        numpy array
+            (len(s), 6) array of Run_MCMC1 results. The steps include
+            those of a fallback search.
+    '''
+    results = []
+    previous = None
+    for i in range(len(s)):
+        if previous is None:
+            result = Run_MCMC1(s[i], eta[i], theta, adaptive, seed)
+            value = objective.Objective(
+                result[:5], objective.Sample_Constants(s[i], eta[i], theta))
+        else:
+            result, value = _Search_Near(s[i], eta[i], theta, previous,
+                                         previous_value, Run_MCMC1,
+                                         adaptive, seed, warm)
+        results.append(result)
+        previous, previous_value = result, value
+    return np.array(results)
+
+
+def Run_Measured(function, arguments, profile=False):
+    '''
+    Calls function(*arguments) and measures the call
+
+    Arguments:
+        function : function
+            Stage function
+        arguments : tuple
+            Its arguments
+        profile : bool
+            Also collect cProfile statistics of the call
+
+    Returns:
+        result
+            Return value of function
+        metrics : dict
+            wall and cpu time (seconds), objective evaluations, mean
+            acceptance fraction of the MCMC samplers (None without
+            one), L-BFGS-B iterations, peak resident memory of the
+            process (MB), its pid and, if profile is set, the cProfile
+            statistics
+    '''
+    _TASK_STATS.clear()
+    evaluations = objective.EVALUATIONS
+    profiler = cProfile.Profile() if profile else None
+    start, start_cpu = time.time(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        result = function(*arguments)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    metrics = {'wall': time.time() - start,
+               'cpu': time.process_time() - start_cpu,
+               'evaluations': objective.EVALUATIONS - evaluations,
+               'acceptance': None,
+               'iterations': int(sum(_TASK_STATS.get('iterations', []))),
+               'peak_rss_mb': JetCurryMetrics.peak_rss_mb(),
+               'pid': os.getpid()}
+    if 'acceptance' in _TASK_STATS:
+        metrics['acceptance'] = float(np.mean(_TASK_STATS['acceptance']))
+    if profiler is not None:
+        profiler.create_stats()
+        metrics['profile'] = profiler.stats
+    return result, metrics
+
+
+def _Init_Worker(log=None):
+    '''
+    Gives every worker process its own random state. Forked workers
+    would otherwise all inherit the parent's numpy seed. log is the
+    (queue, level) of the run's log file, see JetCurryLogger.
+    '''
+    np.random.seed()
+    if log is not None:
+        JetCurryLogger.attach_worker(*log)
+
+
+def _Run_Task(job):
+    '''
+    Unpacks an (index, function, arguments, profile) job for
+    Pool.imap_unordered and runs it with Run_Measured
+    '''
+    i, function, arguments, profile = job
+    return (i,) + Run_Measured(function, arguments, profile)
+
+
+def Run_Parallel(function, tasks, jobs=None, checkpoint=None, queue=None,
+                 metrics=None):
+    '''
+    Runs a per-sample stage function over a pool of worker processes
+
+    Arguments:
+        function : function
+            Module level stage function, e.g. Run_MCMC1
+        tasks : list of tuples
+            Arguments of each call to function
+        jobs : int
+            Number of worker processes. Defaults to the number of cores
+        checkpoint : JetCurryCheckpoint.CheckpointStore
+            Optional store of finished samples. Tasks already in the
+            store are not run again and every new result is stored as
+            soon as it arrives
+        queue : string
+            Optional queue directory on a shared filesystem. Tasks are
+            then run by JetCurryWorker.py processes, on any machine,
+            instead of a local pool, see JetCurryQueue
+        metrics : JetCurryMetrics.RunMetrics
+            Optional collector of the metrics of every task
+
+    Returns:
+        results : list
+            Return value of each call, in the same order as tasks
+    '''
+    profile = metrics is not None and metrics.profile
+    results = [None] * len(tasks)
+    keys = [None] * len(tasks)
+    todo = []
+    for i, task in enumerate(tasks):
+        if checkpoint is not None:
+            keys[i] = checkpoint.key(function.__name__, task)
+            results[i] = checkpoint.get(keys[i])
+        if results[i] is None:
+            todo.append((i, function, task, profile))
+    if metrics is not None:
+        metrics.start_tasks(len(tasks), len(tasks) - len(todo))
+    if not todo:
+        return results
+
+    if jobs is None:
+        jobs = cpu_count()
+    jobs = max(1, min(jobs, len(todo)))
+    pool = None
+    if queue is not None:
+        finished = JetCurryQueue.run_tasks(
+            function, [(i, task) for i, _, task, _ in todo], queue,
+            profile=profile)
+    elif jobs == 1:
+        finished = map(_Run_Task, todo)
+    else:
+        # Several small chunks per worker keep every core busy when
+        # some samples take much longer than others
+        chunksize = max(1, len(todo) // (4 * jobs))
+        pool = Pool(jobs, initializer=_Init_Worker,
+                    initargs=(JetCurryLogger.worker_log_queue(),))
+        finished = pool.imap_unordered(_Run_Task, todo, chunksize)
+    try:
+        for i, result, task_metrics in finished:
+            results[i] = result
+            if checkpoint is not None:
+                checkpoint.put(keys[i], result)
+            if metrics is not None:
+                # Warm-start chains return one row per sample
+                task_metrics['samples'] = len(result) if np.ndim(result) == 2 else 1
+                metrics.add_task(i, task_metrics)
+    except BaseException:
+        # Stop the remaining tasks instead of waiting for them, also
+        # on Ctrl-C
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return results
+
+
+# Sample index followed by the solution vector of a stage and the
+# number of MCMC steps run for the sample (0 for the annealing stages)
+PARAMETERS = ('alpha', 'beta', 'phi', 'xi', 'd')
+STAGE_DTYPE = ([('index', int)] + [(name, float) for name in PARAMETERS] +
+               [('steps', int)])
+
+
+def _Stage_Array(results, samples=None):
+    '''
+    Packs the per-sample vectors returned by a stage, in sample order,
+    into a structured array with STAGE_DTYPE. samples are the indices
+    of the sample points, by default all of them in order.
+    '''
+    stage = np.zeros(len(results), dtype=STAGE_DTYPE)
+    if samples is None:
+        samples = np.arange(len(results))
+    stage['index'] = samples
+    for k, name in enumerate(PARAMETERS):
+        stage[name] = [r[k] for r in results]
+    stage['steps'] = [r[5] if len(r) > 5 else 0 for r in results]
+    return stage
+
+
+def Stage_Vectors(stage):
+    '''
+    Returns the (n, 5) [alpha, beta, phi, xi, d] array of a stage result
+    '''
+    return np.column_stack([stage[name] for name in PARAMETERS])
+
+
+def Write_Stage_Results(stage, output_directory, filename, stage_name):
+    '''
+    Writes a stage result to <filename>_<stage_name>.txt, one
+    tab separated [alpha, beta, phi, xi, d] vector per line followed
+    by the sample index
+
+    Arguments:
+        stage : numpy structured array
+            Result of one of the *_Parallel stages
+        output_directory : string
+            Path of location to save data products
+        filename : string
+            Root name of file to be saved
+        stage_name : string
+            MCMC1, MCMC2, ANNE1 or ANNE2
+    '''
+    np.savetxt(output_directory + filename + '_' + stage_name + '.txt',
+               np.column_stack([Stage_Vectors(stage), stage['index']]),
+               fmt=['%s'] * 5 + ['%d'], delimiter='\t')
+
+
+def _Box_Corner(v):
+    '''
+    Rounds alpha, beta, phi and xi down to the 0.1 grid that defines
+    the search box of the following stage
+    '''
+    return [float(0.1 * floor(10 * value)) for value in v[:4]]
+
+
+def MCMC1_Parallel(s, eta, theta, jobs=None, checkpoint=None,
+                   queue=None, adaptive=None, seed=None, warm=None,
+                   metrics=None, samples=None):
+    '''
+    Runs Run_MCMC1 for every sample point
+
+    Arguments:
+        s, eta : list or numpy array
+            Output of Calculate_s_and_eta
+        theta : float
+            Line of sight angle (radians)
+        jobs : int
+            Number of worker processes, see Run_Parallel
+        checkpoint : JetCurryCheckpoint.CheckpointStore
+            Optional store of finished samples, see Run_Parallel
+        queue : string
+            Optional shared work queue directory, see Run_Parallel
+        adaptive : dict
+            Optional adaptive stopping settings, see _Run_Sampler
+        seed : dict
+            Optional seeding settings, see Seed_Walkers
+        warm : dict
+            Optional warm-start settings, see Run_Warm_Chain. The chains
+            of consecutive samples are then run in parallel
+        metrics : JetCurryMetrics.RunMetrics
+            Optional collector of task metrics, see Run_Parallel
+        samples : numpy array
+            Optional indices of the sample points to solve, e.g. those
+            of Coarse_Samples. All sample points by default
+
+    Returns:
+        numpy structured array
+            Solution of each sample, with STAGE_DTYPE
+    '''
+    s, eta = np.asarray(s), np.asarray(eta)
+    if samples is not None:
+        s, eta = s[samples], eta[samples]
+    if warm is not None:
+        length = dict(WARM_SETTINGS, **warm)['length']
+        tasks = [(s[i:i + length], eta[i:i + length], theta,
+                  adaptive, seed, warm) for i in range(0, len(s), length)]
+        chains = Run_Parallel(Run_Warm_Chain, tasks, jobs, checkpoint, queue,
+                              metrics)
+        return _Stage_Array([result for chain in chains for result in chain],
+                            samples)
+    tasks = [(s[i], eta[i], theta, adaptive, seed) for i in range(len(s))]
+    return _Stage_Array(Run_Parallel(Run_MCMC1, tasks, jobs, checkpoint, queue,
+                                     metrics), samples)
+
+
+def RunMCMC2(s, eta, d0, theta, a, b, c, e, adaptive=None, seed=None,
+             posterior=None, warm=None):
+    '''
+    Narrow MCMC search around the Run_MCMC1 solution of one sample point
+
+    Arguments:
+        s, eta, theta : float
+            See Run_MCMC1
+        d0 : float
+            Run_MCMC1 distance d
+        a, b, c, e : float
+            Lower corner of the alpha, beta, phi and xi search box
+        adaptive, seed, posterior : dict
+            See Run_MCMC1
+        warm : dict
+            Optional settings overriding WARM_SETTINGS. The compact
+            ensemble of Run_MCMC_Warm is then run within 'width' of
+            the centre of the box and of d0, instead of seeding with
+            seed
+
+    Returns:
+        numpy array
+            See Run_MCMC1
+    '''
+    lower = np.array([a, b, c, e, floor(d0)])
+    upper = np.array([a + 0.2, b + 0.2, c + 0.2, e + 0.2,
+                      floor(d0) + 3 * 20.25])
+    constants = objective.Sample_Constants(s, eta, theta)
+
+    start = None
+    if warm is not None:
+        start = _Warm_Start(constants, lower, upper,
+                            np.array([a + 0.1, b + 0.1, c + 0.1, e + 0.1, d0]),
+                            warm)
+    if start is not None:
+        pos, lower, upper = start
+    elif seed is not None:
+        pos = Seed_Walkers(constants, lower, upper, seed)
+    else:
+        pos = _Grid(np.arange(a, a + 0.2, 0.05),
+                    np.arange(b, b + 0.2, 0.05),
+                    np.arange(c, c + 0.2, 0.05),
+                    np.arange(e, e + 0.2, 0.05),
+                    np.arange(floor(d0), floor(d0) + 2.0, 0.5))
+    return _Run_Sampler(pos, constants, lower, upper, adaptive, posterior)
+
+
+def _Posterior_Argument(posterior):
+    '''
+    Trailing task argument with the settings of the posterior draws,
+    without the store path. Empty without a store, which keeps the
+    checkpoint keys of such runs unchanged.
+    '''
+    if posterior is None:
+        return ()
+    return (dict((k, v) for k, v in posterior.items() if k != 'path'),)
+
+
+def MCMC2_Parallel(s, eta, theta, mcmc1, jobs=None, checkpoint=None,
+                   queue=None, adaptive=None, seed=None, metrics=None,
+                   posterior=None, warm=None):
+    '''
+    Runs RunMCMC2 for every sample point of the MCMC1_Parallel result
+    mcmc1, starting from its solution. posterior is an optional dict
+    with the 'path' of a store made by Create_Posterior and settings
+    overriding POSTERIOR_SETTINGS; the draws of each sample point come
+    back with its result and are written to the row of its index. With
+    warm, every sample point runs the
+    compact warm-start ensemble, see RunMCMC2. Other arguments and the
+    return value are the same as MCMC1_Parallel.
+    '''
+    first = Stage_Vectors(mcmc1)
+    tasks = []
+    for j, v in zip(mcmc1['index'], first):
+        extra = _Posterior_Argument(posterior)
+        if warm is not None:
+            # Only warm runs pass warm, so that the checkpoint keys of
+            # other runs stay the same
+            extra = (extra[0] if extra else None, warm)
+        tasks.append((s[j], eta[j], v[4], theta) + tuple(_Box_Corner(v)) +
+                     (adaptive, seed) + extra)
+    results = Run_Parallel(RunMCMC2, tasks, jobs, checkpoint, queue, metrics)
+    if posterior is not None:
+        Write_Posterior(posterior['path'], mcmc1['index'], results)
+    return _Stage_Array(results, mcmc1['index'])
+
+
+# Coarse-to-fine mode, see Coarse_Samples and Refine_Parallel. Only
+# every 'step'-th sample point gets the full MCMC1 and MCMC2 search.
+COARSE_SETTINGS = {'step': 4}
+
+
+def Coarse_Samples(n, step=COARSE_SETTINGS['step']):
+    '''
+    Indices of every step-th of n sample points, always including the
+    last one so that the other points lie between two of them
+    '''
+    samples = np.arange(0, n, step)
+    if samples[-1] != n - 1:
+        samples = np.append(samples, n - 1)
+    return samples
+
+
+def Full_Search(s, eta, theta, adaptive=None, seed=None, posterior=None):
+    '''
+    Run_MCMC1 followed by RunMCMC2, the search every sample point gets
+    in a normal run. Arguments and return value are the same as
+    Run_MCMC1; the steps are those of both searches and the posterior
+    draws those of RunMCMC2.
+    '''
+    first = Run_MCMC1(s, eta, theta, adaptive, seed)
+    second = RunMCMC2(s, eta, first[4], theta, *_Box_Corner(first),
+                      adaptive=adaptive, seed=seed, posterior=posterior)
+    second[5] += first[5]
+    return second
+
+
+def Run_MCMC_Refine(s, eta, theta, guess, reference, adaptive=None,
+                    seed=None, warm=None, posterior=None):
+    '''
+    Narrow search of a sample point between two coarse sample points
+
+    Arguments:
+        s, eta, theta : float
+            See Run_MCMC1
+        guess : numpy array
+            Solution interpolated from the coarse sample points
+        reference : float
+            Larger objective of the two coarse sample points. A narrow
+            fit much worse than this is searched in full, see _Search_Near
+        adaptive, seed : dict
+            See Run_MCMC1
+        warm : dict
+            Settings overriding WARM_SETTINGS of the narrow search
+        posterior : dict
+            See Run_MCMC1
+
+    Returns:
+        numpy array
+            See Run_MCMC1
+    '''
+    return _Search_Near(s, eta, theta, guess, reference, Full_Search,
+                        adaptive, seed, warm, posterior)[0]
+
+
+def Refine_Parallel(s, eta, theta, coarse, jobs=None, checkpoint=None,
+                    queue=None, adaptive=None, seed=None, warm=None,
+                    metrics=None, posterior=None, mcmc1=None):
+    '''
+    Fills in the sample points that MCMC1_Parallel and MCMC2_Parallel
+    did not solve. Each is started from the solutions of the coarse
+    sample points on either side, interpolated along the jet, and runs
+    Run_MCMC_Refine.
+
+    Arguments:
+        coarse : numpy structured array
+            MCMC2_Parallel result of the Coarse_Samples sample points
+        posterior : dict
+            See MCMC2_Parallel
+        mcmc1 : numpy structured array
+            MCMC1_Parallel result of the coarse sample points. Its steps
+            are added to those of coarse
+        Other arguments are the same as MCMC1_Parallel
+
+    Returns:
+        numpy structured array
+            Solution of every sample point, with STAGE_DTYPE. The rows
+            of the coarse sample points are those of coarse. The steps
+            of every row are all MCMC steps run for its sample point,
+            MCMC1 and MCMC2 for the coarse ones and the narrow (and any
+            full) search for the others.
+    '''
+    samples = np.asarray(coarse['index'])
+    vectors = Stage_Vectors(coarse)
+    values = np.array([objective.Objective(
+        v, objective.Sample_Constants(s[j], eta[j], theta))
+        for j, v in zip(samples, vectors)])
+    values[~np.isfinite(values)] = np.inf
+    fine = np.setdiff1d(np.arange(len(s)), samples)
+    guesses = np.column_stack([np.interp(fine, samples, vectors[:, k])
+                               for k in range(len(PARAMETERS))])
+    right = np.clip(np.searchsorted(samples, fine), 1, len(samples) - 1)
+    reference = np.maximum(values[right - 1], values[right])
+    tasks = [(s[j], eta[j], theta, guesses[i], reference[i], adaptive, seed,
+              warm) + _Posterior_Argument(posterior)
+             for i, j in enumerate(fine)]
+    refined = Run_Parallel(Run_MCMC_Refine, tasks, jobs, checkpoint, queue,
+                           metrics)
+    if posterior is not None:
+        Write_Posterior(posterior['path'], fine, refined)
+
+    results = np.zeros((len(s), 6))
+    results[samples, :5] = vectors
+    results[samples, 5] = coarse['steps']
+    if mcmc1 is not None:
+        results[samples, 5] += mcmc1['steps']
+    for j, result in zip(fine, refined):
+        results[j] = result[:6]
+    return _Stage_Array(results)
+
+
+def Annealing1(eta, s, theta, alpha0, beta0, phi0, xi0, d0, a, b, c, e):
+    '''
+    Bounded L-BFGS-B refinement of the RunMCMC2 solution of one sample point
+
+    Arguments:
+        eta, s, theta : float
+            See Run_MCMC1
+        alpha0, beta0, phi0, xi0, d0 : float
+            Starting vector
+        a, b, c, e : float
+            Lower corner of the alpha, beta, phi and xi bounds
+
+    Returns:
+        numpy array
+            Refined [alpha, beta, phi, xi, d] vector
+    '''
+
     x0 = np.array([float(alpha0), float(beta0),
                    float(phi0), float(xi0), float(d0)])
     xmin = [a, b, c, e, float(floor(d0))]
@@ -470,215 +1133,44 @@ def Annealing1(eta, s, theta, alpha0, beta0, phi0, xi0, d0, a, b, c, e, ind, out
             float(e + 0.2), float(floor(d0) + 2.0)]
     bounds = [(low, high) for low, high in zip(xmin, xmax)]
     res = fmin_l_bfgs_b(
-        f,
+        objective.Objective_And_Gradient,
         x0,
         fprime=None,
-        args=(),
-        approx_grad=True,
+        args=(objective.Sample_Constants(s, eta, theta),),
+        approx_grad=False,
         bounds=bounds,
         m=10,
         factr=10000000.0,
         pgtol=1e-05,
-        epsilon=1e-08,
         iprint=-1,
         maxfun=150,
         maxiter=150,
         disp=None,
         callback=None)
-    q = res
-
-    with open(output_directory + filename + '_ANNE1.txt', 'a') as file:
-        file.write(str(q[0][0]) +
-                   '\t' +
-                   str(q[0][1]) +
-                   '\t' +
-                   str(q[0][2]) +
-                   '\t' +
-                   str(q[0][3]) +
-                   '\t' +
-                   str(q[0][4]) +
-                   '\t' +
-                   str(ind) +
-                   '\n')
-    return
-
-
-def Annealing1_Parallel(s, eta, theta, output_directory, filename):
-    '''
-    '''
-    alpha_MCMC2 = []
-    beta_MCMC2 = []
-    phi_MCMC2 = []
-    xi_MCMC2 = []
-    d_MCMC2 = []
-    for line in open(output_directory + filename + '_MCMC2.txt', 'r').readlines():
-        if line.startswith('#'):
-            continue
-        if line.startswith('\n'):
-            continue
-        fields = line.split()
-        object_alpha = fields[0]
-        alpha_MCMC2.append(object_alpha)
-        object_beta = fields[1]
-        beta_MCMC2.append(object_beta)
-        object_phi = fields[2]
-        phi_MCMC2.append(object_phi)
-        object_xi = fields[3]
-        xi_MCMC2.append(object_xi)
-        object_d = fields[4]
-        d_MCMC2.append(object_d)
-    for k in range(0, len(alpha_MCMC2), 4):
-        alpha0 = float(alpha_MCMC2[k])
-        beta0 = float(beta_MCMC2[k])
-        phi0 = float(phi_MCMC2[k])
-        xi0 = float(xi_MCMC2[k])
-        d0 = float(d_MCMC2[k])
-        a = float(0.1 * (floor(10 * alpha0)))
-        b = float(0.1 * floor(10 * beta0))
-        c = float(0.1 * floor(10 * phi0))
-        e = float(0.1 * floor(10 * xi0))
-        q = Process(
-            target=Annealing1,
-            args=(
-                eta[k],
-                s[k],
-                theta,
-                alpha0,
-                beta0,
-                phi0,
-                xi0,
-                d0,
-                a,
-                b,
-                c,
-                e,
-                k, output_directory, filename))
-        q.start()
-        q.join()
-        alpha1 = float(alpha_MCMC2[k + 1])
-        beta1 = float(beta_MCMC2[k + 1])
-        phi1 = float(phi_MCMC2[k + 1])
-        xi1 = float(xi_MCMC2[k + 1])
-        d1 = float(d_MCMC2[k + 1])
-        a1 = float(0.1 * (floor(10 * alpha1)))
-        b1 = float(0.1 * floor(10 * beta1))
-        c1 = float(0.1 * floor(10 * phi1))
-        e1 = float(0.1 * floor(10 * xi1))
-        q1 = Process(target=Annealing1,
-                     args=(eta[k + 1],
-                           s[k + 1],
-                           theta,
-                           alpha1,
-                           beta1,
-                           phi1,
-                           xi1,
-                           d1,
-                           a1,
-                           b1,
-                           c1,
-                           e1,
-                           k + 1, output_directory, filename))
-        q1.start()
-        q1.join()
-        alpha2 = float(alpha_MCMC2[k + 2])
-        beta2 = float(beta_MCMC2[k + 2])
-        phi2 = float(phi_MCMC2[k + 2])
-        xi2 = float(xi_MCMC2[k + 2])
-        d2 = float(d_MCMC2[k + 2])
-        a2 = float(0.1 * (floor(10 * alpha2)))
-        b2 = float(0.1 * floor(10 * beta2))
-        c2 = float(0.1 * floor(10 * phi2))
-        e2 = float(0.1 * floor(10 * xi2))
-        q2 = Process(target=Annealing1,
-                     args=(eta[k + 2],
-                           s[k + 2],
-                           theta,
-                           alpha2,
-                           beta2,
-                           phi2,
-                           xi2,
-                           d2,
-                           a2,
-                           b2,
-                           c2,
-                           e2,
-                           k + 2, output_directory, filename))
-        q2.start()
-        q2.join()
-        alpha3 = float(alpha_MCMC2[k + 3])
-        beta3 = float(beta_MCMC2[k + 3])
-        phi3 = float(phi_MCMC2[k + 3])
-        xi3 = float(xi_MCMC2[k + 3])
-        d3 = float(d_MCMC2[k + 3])
-        a3 = float(0.1 * (floor(10 * alpha3)))
-        b3 = float(0.1 * floor(10 * beta3))
-        c3 = float(0.1 * floor(10 * phi3))
-        e3 = float(0.1 * floor(10 * xi3))
-        q3 = Process(target=Annealing1,
-                     args=(eta[k + 3],
-                           s[k + 3],
-                           theta,
-                           alpha3,
-                           beta3,
-                           phi3,
-                           xi3,
-                           d3,
-                           a3,
-                           b3,
-                           c3,
-                           e3,
-                           k + 3, output_directory, filename))
-        q3.start()
-        q3.join()
-    return
-
-def Annealing2(eta, s, theta, alpha0, beta0, phi0, xi0, d0, a, b, c, e, ind, output_directory, filename):
-    '''
-    '''
-
-    def f(x):
-        '''
-        '''
-        alpha, beta, phi, xi, d = x
-        return ((((s *
-                   np.sin(eta)) /
-                  np.sin(phi))**2 +
-                 (s *
-                  np.cos(eta) *
-                  (np.sin(theta) *
-                   np.cos(alpha) +
-                   np.sin(alpha) *
-                   np.cos(theta)) /
-                  np.cos(alpha))**2 -
-                 d**2)**2 +
-                (((np.sin(beta) *
-                   np.cos(alpha)) /
-                  (np.sin(alpha) *
-                   np.cos(beta)))**2 -
-                 (np.cos(eta)**2))**2 +
-                (d *
-                 np.cos(xi) *
-                 np.cos(theta) -
-                 ((s *
-                   np.cos(eta) *
-                   np.sin(alpha)) /
-                  np.cos(alpha)) -
-                 d *
-                 np.sin(xi) *
-                 np.cos(phi) *
-                 np.sin(theta))**2 +
-                ((np.sin(eta) /
-                  np.cos(eta)) -
-                 ((np.sin(xi) *
-                   np.sin(phi)) /
-                    (np.cos(xi) *
-                     np.sin(theta) +
-                     np.sin(xi) *
-                     np.cos(phi) *
-                     np.cos(theta))))**2 +
-                (s -
-                 d *
-                 np.cos(beta))**2)
+    _TASK_STATS.setdefault('iterations', []).append(res[2]['nit'])
+    return res[0]
+
+
+def Annealing1_Parallel(s, eta, theta, mcmc2, jobs=None,
+                        checkpoint=None, queue=None, metrics=None):
+    '''
+    Runs Annealing1 for every sample point, starting from the
+    MCMC2_Parallel result mcmc2. Other arguments and the return value
+    are the same as MCMC1_Parallel.
+    '''
+    previous = Stage_Vectors(mcmc2)
+    tasks = [(eta[k], s[k], theta) + tuple(previous[k]) +
+             tuple(_Box_Corner(previous[k])) for k in range(len(previous))]
+    return _Stage_Array(Run_Parallel(Annealing1, tasks, jobs, checkpoint,
+                                     queue, metrics))
+
+
+def Annealing2(eta, s, theta, alpha0, beta0, phi0, xi0, d0, a, b, c, e):
+    '''
+    Second, tighter L-BFGS-B refinement of the Annealing1 solution.
+    Arguments and return value are the same as Annealing1.
+    '''
+
     x0 = np.array([float(alpha0), float(beta0),
                    float(phi0), float(xi0), float(d0)])
     xmin = [a, b, c, e, float(floor(d0))]
@@ -687,224 +1179,103 @@ def Annealing2(eta, s, theta, alpha0, beta0, phi0, xi0, d0, a, b, c, e, ind, out
     bounds = [(low, high) for low, high in zip(xmin, xmax)]
 
     res = fmin_l_bfgs_b(
-        f,
+        objective.Objective_And_Gradient,
         x0,
         fprime=None,
-        args=(),
-        approx_grad=True,
+        args=(objective.Sample_Constants(s, eta, theta),),
+        approx_grad=False,
         bounds=bounds,
         m=10,
         factr=10000000.0,
         pgtol=1e-05,
-        epsilon=1e-08,
         iprint=-1,
         maxfun=150,
         maxiter=150,
         disp=None,
         callback=None)
-    q = res
-
-    with open(output_directory + filename + '_ANNE2.txt', 'a') as file:
-        file.write(str(q[0][0]) +
-                   '\t' +
-                   str(q[0][1]) +
-                   '\t' +
-                   str(q[0][2]) +
-                   '\t' +
-                   str(q[0][3]) +
-                   '\t' +
-                   str(q[0][4]) +
-                   '\t' +
-                   str(ind) +
-                   '\n')
-    return
-
-def Annealing2_Parallel(s, eta, theta, output_directory, filename):
-    '''
-    '''
-    alpha_ANNE1 = []
-    beta_ANNE1 = []
-    phi_ANNE1 = []
-    xi_ANNE1 = []
-    d_ANNE1 = []
-
-    for line in open(output_directory + filename + '_ANNE1.txt', 'r').readlines():
-        if line.startswith('#'):
-            continue
-        if line.startswith('\n'):
-            continue
-        fields = line.split()
-        object_alpha = fields[0]
-        alpha_ANNE1.append(object_alpha)
-        object_beta = fields[1]
-        beta_ANNE1.append(object_beta)
-        object_phi = fields[2]
-        phi_ANNE1.append(object_phi)
-        object_xi = fields[3]
-        xi_ANNE1.append(object_xi)
-        object_d = fields[4]
-        d_ANNE1.append(object_d)
-    for k in range(0, len(alpha_ANNE1), 4):
-        alpha0 = float(alpha_ANNE1[k])
-        beta0 = float(beta_ANNE1[k])
-        phi0 = float(phi_ANNE1[k])
-        xi0 = float(xi_ANNE1[k])
-        d0 = float(d_ANNE1[k])
-        a = float(0.1 * (floor(10 * alpha0)))
-        b = float(0.1 * floor(10 * beta0))
-        c = float(0.1 * floor(10 * phi0))
-        e = float(0.1 * floor(10 * xi0))
-        q = Process(
-            target=Annealing2,
-            args=(
-                eta[k],
-                s[k],
-                theta,
-                alpha0,
-                beta0,
-                phi0,
-                xi0,
-                d0,
-                a,
-                b,
-                c,
-                e,
-                k, output_directory, filename))
-        q.start()
-        q.join()
-        alpha1 = float(alpha_ANNE1[k + 1])
-        beta1 = float(beta_ANNE1[k + 1])
-        phi1 = float(phi_ANNE1[k + 1])
-        xi1 = float(xi_ANNE1[k + 1])
-        d1 = float(d_ANNE1[k + 1])
-        a1 = float(0.1 * (floor(10 * alpha1)))
-        b1 = float(0.1 * floor(10 * beta1))
-        c1 = float(0.1 * floor(10 * phi1))
-        e1 = float(0.1 * floor(10 * xi1))
-        q1 = Process(target=Annealing2,
-                     args=(eta[k + 1],
-                           s[k + 1],
-                           theta,
-                           alpha1,
-                           beta1,
-                           phi1,
-                           xi1,
-                           d1,
-                           a1,
-                           b1,
-                           c1,
-                           e1,
-                           k + 1, output_directory, filename))
-        q1.start()
-        q1.join()
-        alpha2 = float(alpha_ANNE1[k + 2])
-        beta2 = float(beta_ANNE1[k + 2])
-        phi2 = float(phi_ANNE1[k + 2])
-        xi2 = float(xi_ANNE1[k + 2])
-        d2 = float(d_ANNE1[k + 2])
-        a2 = float(0.1 * (floor(10 * alpha2)))
-        b2 = float(0.1 * floor(10 * beta2))
-        c2 = float(0.1 * floor(10 * phi2))
-        e2 = float(0.1 * floor(10 * xi2))
-        q2 = Process(target=Annealing2,
-                     args=(eta[k + 2],
-                           s[k + 2],
-                           theta,
-                           alpha2,
-                           beta2,
-                           phi2,
-                           xi2,
-                           d2,
-                           a2,
-                           b2,
-                           c2,
-                           e2,
-                           k + 2, output_directory, filename))
-        q2.start()
-        q2.join()
-        alpha3 = float(alpha_ANNE1[k + 3])
-        beta3 = float(beta_ANNE1[k + 3])
-        phi3 = float(phi_ANNE1[k + 3])
-        xi3 = float(xi_ANNE1[k + 3])
-        d3 = float(d_ANNE1[k + 3])
-        a3 = float(0.1 * (floor(10 * alpha3)))
-        b3 = float(0.1 * floor(10 * beta3))
-        c3 = float(0.1 * floor(10 * phi3))
-        e3 = float(0.1 * floor(10 * xi3))
-        q3 = Process(target=Annealing2,
-                     args=(eta[k + 3],
-                           s[k + 3],
-                           theta,
-                           alpha3,
-                           beta3,
-                           phi3,
-                           xi3,
-                           d3,
-                           a3,
-                           b3,
-                           c3,
-                           e3,
-                           k + 3, output_directory, filename))
-        q3.start()
-        q3.join()
-    return
-
-
-def Convert_Results_Cartesian(s, eta, theta, output_directory, filename):
-    '''
-    '''
-    x_coordinates = []
-    y_coordinates = []
-    z_coordinates = []
-    alpha = []
-    beta = []
-    phi = []
-    xi = []
-    d = []
-    for line in open(output_directory + filename + '_ANNE2.txt', 'r').readlines():
-        if line.startswith('#'):
-            continue
-        # if line.startswith('\n'):
-        #   continue
-        fields = line.split()
-        alpha.append(fields[0])
-        beta.append(fields[1])
-        phi.append(fields[2])
-        xi.append(fields[3])
-        d.append(fields[4])
-    for line in open(output_directory + filename + '_parameters.txt', 'r').readlines():
-        if line.startswith('#'):
-            continue
-        if line.startswith('\n'):
-            continue
-        fields = line.split()
-        eta.append(fields[1])
-    # Convert to Float data type
-    d = [float(i) for i in d]
-    alpha = [float(i) for i in alpha]
-    beta = [float(i) for i in beta]
-    xi = [float(i) for i in xi]
-    eta = [float(i) for i in eta]
-    phi = [float(i) for i in phi]
-
-    for i in range(len(alpha)):
-
-        x_value = d[i] * np.cos(eta[i]) * np.cos(beta[i]) + 15
-        z_value = d[i] * np.cos(beta[i]) * np.cos(eta[i]) * np.tan(alpha[i])
-        z_coordinates.append(z_value)
-
-        y_value = d[i] * np.cos(beta[i]) * np.sin(eta[i])
-
-        x_coordinates.append(x_value)
-        y_coordinates.append(y_value + 13)
-
-    with open(output_directory + filename + '_Cartesian_Coordinates.txt', 'w') as file:
-    # Write Results to File
-        for i in range(len(x_coordinates)):
-            file.write(str(x_coordinates[i]) +
-                       '\t' +
-                       str(y_coordinates[i]) +
-                       '\t' +
-                       str(z_coordinates[i]) +
-                       '\n')
-    return x_coordinates, y_coordinates, z_coordinates
+    _TASK_STATS.setdefault('iterations', []).append(res[2]['nit'])
+    return res[0]
+
+def Annealing2_Parallel(s, eta, theta, anne1, jobs=None,
+                        checkpoint=None, queue=None, metrics=None):
+    '''
+    Runs Annealing2 for every sample point, starting from the
+    Annealing1_Parallel result anne1. Other arguments and the return value
+    are the same as MCMC1_Parallel.
+    '''
+    previous = Stage_Vectors(anne1)
+    tasks = [(eta[k], s[k], theta) + tuple(previous[k]) +
+             tuple(_Box_Corner(previous[k])) for k in range(len(previous))]
+    return _Stage_Array(Run_Parallel(Annealing2, tasks, jobs, checkpoint,
+                                     queue, metrics))
+
+
+def Cartesian_Coordinates(parameters, eta):
+    '''
+    Converts jet geometry vectors to Cartesian coordinates
+
+    Arguments:
+        parameters : numpy array
+            [alpha, beta, phi, xi, d] vectors, shape (..., 5)
+        eta : float or numpy array
+            Projected angle, broadcastable to parameters.shape[:-1]
+
+    Returns:
+        x, y, z : numpy array
+            Coordinates with shape parameters.shape[:-1]. z is along
+            the line of sight
+    '''
+    parameters = np.asarray(parameters, dtype=float)
+    alpha = parameters[..., 0]
+    beta = parameters[..., 1]
+    d = parameters[..., 4]
+    projected = d * np.cos(beta)
+    x = projected * np.cos(eta) + 15
+    y = projected * np.sin(eta) + 13
+    z = projected * np.cos(eta) * np.tan(alpha)
+    return x, y, z
+
+
+# Percentiles of the Cartesian coordinates over the posterior draws
+PERCENTILES = (16, 50, 84)
+
+
+def Convert_Results_Cartesian(parameters, eta, percentiles=PERCENTILES):
+    '''
+    Converts the solution of every sample to Cartesian coordinates
+
+    Arguments:
+        parameters : numpy array
+            Stage result with STAGE_DTYPE, an (n, 5) array with one
+            vector per sample, or an (n, ndraws, 5) array of posterior
+            draws per sample
+        eta : numpy array
+            Projected angle of each of the n samples
+        percentiles : sequence of float
+            Percentiles reported when posterior draws are given
+
+    Returns:
+        x, y, z : numpy array
+            Coordinates of each sample, shape (n,). For posterior draws
+            the percentiles of each coordinate over the draws, shape
+            (len(percentiles), n)
+    '''
+    parameters = np.asarray(parameters)
+    if parameters.dtype.names is not None:
+        parameters = Stage_Vectors(parameters)
+    eta = np.asarray(eta, dtype=float)
+    if np.ndim(parameters) == 3:
+        coordinates = Cartesian_Coordinates(parameters, eta[:, np.newaxis])
+        # Samples may have fewer draws than the store holds (NaN rows)
+        return tuple(np.nanpercentile(c, percentiles, axis=1)
+                     for c in coordinates)
+    return Cartesian_Coordinates(parameters, eta)
+
+
+def Write_Cartesian_Coordinates(x, y, z, output_directory, filename):
+    '''
+    Writes one tab separated x, y, z line per sample to
+    <filename>_Cartesian_Coordinates.txt
+    '''
+    np.savetxt(output_directory + filename + '_Cartesian_Coordinates.txt',
+               np.column_stack([x, y, z]), fmt='%s', delimiter='\t')
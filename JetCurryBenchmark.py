@@ -0,0 +1,387 @@
+'''
+Benchmark of the Jet Curry pipeline on synthetic jets of known geometry
+
+The truth of each case is built inside the model: a path on the sky,
+at a position angle eta above the x axis with an optional wiggle, and
+a known angle alpha. Every sample then has the exact root [alpha, beta,
+phi, xi, d] of the objective (checked, and inside the prior box of the
+broad search), and its true Cartesian coordinates come from
+jet.Cartesian_Coordinates. The path is rendered to a FITS image with
+Gaussian cross-section and noise and run through the full pipeline
+headless. The report gives the wall time of every stage, the samples
+solved per second and the error of the recovered Cartesian coordinates
+against the true ones.
+
+The sky position (x, y) of a sample is fixed by the image, so the 3D
+error is mostly the error in z, that is in alpha. The objective of a
+sample off the x axis is zero along a whole curve of alpha (each with
+its own beta, phi, xi and d), so alpha is not fixed by one sample and
+the 3D error shows how far from the known alpha the search settles.
+A jet along the x axis (eta = 0) is not used: its only root has xi = 0,
+on the edge of the open prior box.
+
+    python JetCurryBenchmark.py -out_dir bench -report bench.json
+    python JetCurryBenchmark.py -cases wiggle -- -warm -hypercube
+    python JetCurryBenchmark.py -reference -- -coarse 4
+
+Arguments after -- are passed to the pipeline, so any change of settings
+can be compared against the defaults. With -reference every case is
+also run at full resolution (-coarse 1) and the report has the
+difference between the two results. With -max_error the benchmark
+fails if the 3D error of a case, or its 3D difference from the full
+resolution run, is larger.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from astropy.io import fits
+import JetCurry as jet
+import JetCurryMain
+import JetCurryResults
+import JetCurryObjective as objective
+
+# Sky length (pixels) and mean position angle (radians) of the jet, the
+# wiggle of tan(eta) and its period along x (pixels), the known alpha
+# (radians), width of the jet (Gaussian sigma, pixels), noise level
+# relative to the peak flux and random seed of the noise
+CASES = {
+    'straight': {'length': 60, 'eta': 0.3, 'wiggle': 0.0, 'period': 30.0,
+                 'alpha': 0.9, 'width': 1.5, 'noise': 0.01, 'seed': 1},
+    'wiggle': {'length': 60, 'eta': 0.3, 'wiggle': 0.1, 'period': 30.0,
+               'alpha': 0.9, 'width': 1.5, 'noise': 0.01, 'seed': 2},
+    'long_wiggle': {'length': 200, 'eta': 0.2, 'wiggle': 0.05,
+                    'period': 80.0, 'alpha': 0.6, 'width': 1.5,
+                    'noise': 0.02, 'seed': 3},
+}
+
+# Pixel of the core. The pipeline takes x relative to the second and
+# y relative to the first upstream coordinate, so both are the same.
+CORE = 20
+# Columns of empty sky after the end of the jet, and rows above it
+MARGIN = 10
+# Largest objective accepted as an exact root
+ROOT_TOLERANCE = 1e-12
+
+
+def sky_path(case, x):
+    '''
+    Position of the jet on the sky, relative to the core
+
+    Arguments:
+        case : dict
+            One of CASES
+        x : numpy array
+            Distance along the x axis
+
+    Returns:
+        y : numpy array
+    '''
+    if not 0 <= case['wiggle'] < np.tan(case['eta']):
+        raise ValueError('wiggle %s must be below tan(eta) = %.3g to keep '
+                         'the jet above the x axis' %
+                         (case['wiggle'], np.tan(case['eta'])))
+    x = np.asarray(x, dtype=float)
+    return x * (np.tan(case['eta']) +
+                case['wiggle'] * np.sin(2 * np.pi * x / case['period']))
+
+
+def true_parameters(case, theta, x):
+    '''
+    Exact root [alpha, beta, phi, xi, d] of the objective at the sky
+    positions x of the jet, for the known alpha of the case. Raises
+    ValueError if a root is outside the prior box of the broad search.
+
+    Returns:
+        parameters : numpy array
+            (n, 5) true vectors, with NaN phi and xi at the core
+        s, eta : numpy array
+    '''
+    x = np.asarray(x, dtype=float)
+    y = sky_path(case, x)
+    s = np.hypot(x, y)
+    eta = np.arctan2(y, x)
+    tan_alpha = np.tan(case['alpha'])
+    beta = np.arctan(tan_alpha * np.cos(eta))
+    d = s / np.cos(beta)
+    # A and D of the objective give phi and xi, then C holds for any
+    # alpha
+    u = s * np.cos(eta) * (np.sin(theta) + np.cos(theta) * tan_alpha)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        phi = np.arcsin(s * np.sin(eta) / np.sqrt(d**2 - u**2))
+        xi = np.arctan2(np.tan(eta) * np.sin(theta),
+                        np.sin(phi) - np.tan(eta) * np.cos(phi) *
+                        np.cos(theta))
+    parameters = np.column_stack(
+        [np.full_like(s, case['alpha']), beta, phi, xi, d])
+
+    for i in np.flatnonzero(s > 0):
+        lower, upper = jet._MCMC1_Box(s[i], theta)
+        constants = objective.Sample_Constants(s[i], eta[i], theta)
+        value = objective.Objective(parameters[i:i + 1], constants)[0]
+        if not (np.all(parameters[i] > lower) and
+                np.all(parameters[i] < upper) and value < ROOT_TOLERANCE):
+            raise ValueError('true vector %s at s = %.3g is not a root inside '
+                             'the prior box (objective %.3g)' %
+                             (parameters[i], s[i], value))
+    return parameters, s, eta
+
+
+def make_image(case, theta):
+    '''
+    Renders a synthetic jet. Raises ValueError if its true geometry is
+    outside the model, see true_parameters.
+
+    Returns:
+        image : numpy array
+            (rows, CORE + length + MARGIN) float32 image
+        upstream_bounds, downstream_bounds : numpy array
+            Bounds of the jet for the pipeline
+    '''
+    true_parameters(case, theta, np.arange(case['length'] + 1))
+    # Points along the jet, well below a quarter pixel apart
+    x = np.arange(0, case['length'], 0.05)
+    y = sky_path(case, x)
+    ny = CORE + int(np.ceil(np.max(y))) + MARGIN
+    nx = CORE + case['length'] + MARGIN
+    rows, columns = np.mgrid[0:ny, 0:nx]
+    image = np.zeros((ny, nx))
+    # Fading brightness along the jet, summed in blocks of points to
+    # keep the broadcast small
+    flux = np.exp(-x / (2.0 * case['length']))
+    for i in range(0, len(x), 256):
+        px = CORE + x[i:i + 256, None, None]
+        py = CORE + y[i:i + 256, None, None]
+        image += np.sum(flux[i:i + 256, None, None] * np.exp(
+            -((columns - px)**2 + (rows - py)**2) /
+            (2 * case['width']**2)), axis=0)
+    image /= image.max()
+    random = np.random.RandomState(case['seed'])
+    image += case['noise'] * random.standard_normal(image.shape)
+    upstream_bounds = np.array([CORE, CORE])
+    downstream_bounds = np.array([CORE + case['length'], CORE])
+    return image.astype(np.float32), upstream_bounds, downstream_bounds
+
+
+def true_coordinates(case, theta, x_smooth):
+    '''
+    True Cartesian coordinates at the sample columns x_smooth, from
+    jet.Cartesian_Coordinates of the true vectors
+    '''
+    parameters, _, eta = true_parameters(
+        case, theta, np.asarray(x_smooth, dtype=float) - CORE)
+    return jet.Cartesian_Coordinates(parameters, eta)
+
+
+def coordinate_errors(recovered, truth):
+    '''
+    RMS error of each coordinate, of the projected (x, y) position and
+    of the 3D position, and the largest projected and 3D errors, over
+    the samples
+    '''
+    difference = np.asarray(recovered, dtype=float) - np.asarray(truth)
+    errors = dict(('rms_' + name, float(np.sqrt(np.mean(d**2))))
+                  for name, d in zip('xyz', difference))
+    for name, d in (('xy', difference[:2]), ('3d', difference)):
+        distance = np.sqrt(np.sum(d**2, axis=0))
+        errors['rms_' + name] = float(np.sqrt(np.mean(distance**2)))
+        errors['max_' + name] = float(np.max(distance))
+    return errors
+
+
+def failed_checks(report, max_error):
+    '''
+    Checks of a case report that exceed max_error: the 3D RMS error
+    against the truth and, if the case has a full resolution reference,
+    the 3D RMS difference from it
+
+    Returns:
+        list of strings
+            Description of each failed check
+    '''
+    if 'error' in report:
+        return [report['error']]
+    checks = [('rms 3d error', report['errors']['rms_3d'])]
+    reference = report.get('reference', {})
+    if 'error' in reference:
+        return ['reference ' + reference['error']]
+    if 'difference' in reference:
+        checks.append(('rms 3d difference from full resolution',
+                       reference['difference']['rms_3d']))
+    return ['%s %.3g > %.3g' % (name, value, max_error)
+            for name, value in checks if not value <= max_error]
+
+
+def _Run_Pipeline(file, upstream_bounds, downstream_bounds, output_directory,
+                  arguments, jobs):
+    '''
+    Runs the pipeline on one synthetic image
+
+    Returns:
+        result_directory : string
+        timings : dict
+            Wall time of every stage
+        wall_time : float
+        x_smooth : numpy array
+        recovered : numpy array
+            (3, n) recovered Cartesian coordinates
+    '''
+    name = os.path.splitext(os.path.basename(file))[0]
+    args = JetCurryMain.parse_arguments(
+        [file, '-jobs', str(jobs),
+         '-upstream'] + [str(v) for v in upstream_bounds] +
+        ['-downstream'] + [str(v) for v in downstream_bounds] +
+        list(arguments))
+    start = time.time()
+    result_directory, timings = JetCurryMain.process_file(
+        file, upstream_bounds, downstream_bounds, output_directory, args, jobs)
+    wall_time = time.time() - start
+
+    with JetCurryResults.read_results(
+            result_directory + name + '_results.fits') as results:
+        x_smooth = np.array(results['PARAMETERS'].data['x_smooth'])
+        cartesian = results['CARTESIAN'].data
+        recovered = np.array([cartesian['x'], cartesian['y'], cartesian['z']])
+    return result_directory, timings, wall_time, x_smooth, recovered
+
+
+def run_case(name, case, theta, output_directory, pipeline_arguments, jobs,
+             reference=False):
+    '''
+    Renders one case, runs the pipeline on it and compares the result
+    with the truth, and with reference also with a full resolution run
+
+    Returns:
+        dict
+            Report of the case
+    '''
+    image, upstream_bounds, downstream_bounds = make_image(case, theta)
+    fits_directory = os.path.join(output_directory, 'synthetic')
+    if not os.path.exists(fits_directory):
+        os.makedirs(fits_directory)
+    file = os.path.join(fits_directory, name + '.fits')
+    fits.PrimaryHDU(image).writeto(file, overwrite=True)
+
+    report = {'name': name, 'case': case, 'samples': int(case['length'])}
+    try:
+        result_directory, timings, wall_time, x_smooth, recovered = \
+            _Run_Pipeline(file, upstream_bounds, downstream_bounds,
+                          os.path.join(output_directory, 'results', ''),
+                          pipeline_arguments, jobs)
+    except (Exception, SystemExit) as e:
+        report['error'] = 'pipeline failed: %s' % e
+        return report
+    truth = true_coordinates(case, theta, x_smooth)
+    np.savetxt(result_directory + name + '_truth.txt',
+               np.column_stack(truth), fmt='%s', delimiter='\t')
+
+    solver_time = sum(timings.get(stage, 0.0) for stage in
+                      ('MCMC1', 'MCMC2', 'refine', 'ANNE1', 'ANNE2'))
+    report.update({
+        'samples': len(x_smooth),
+        'output_directory': result_directory,
+        'wall_time': wall_time,
+        'stage_times': timings,
+        'samples_per_second': len(x_smooth) / wall_time,
+        'solver_samples_per_second': len(x_smooth) / solver_time,
+        'errors': coordinate_errors(recovered, truth),
+    })
+
+    if reference:
+        try:
+            _, reference_timings, reference_time, _, full = _Run_Pipeline(
+                file, upstream_bounds, downstream_bounds,
+                os.path.join(output_directory, 'reference', ''),
+                list(pipeline_arguments) + ['-coarse', '1'], jobs)
+        except (Exception, SystemExit) as e:
+            report['reference'] = {'error': 'pipeline failed: %s' % e}
+        else:
+            report['reference'] = {
+                'wall_time': reference_time,
+                'stage_times': reference_timings,
+                'speedup': reference_time / wall_time,
+                'errors': coordinate_errors(full, truth),
+                'difference': coordinate_errors(recovered, full),
+            }
+    return report
+
+
+def parse_arguments(argv=None):
+    '''
+    Create command line argument parser. Arguments after -- are
+    returned separately, for the pipeline.
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+    pipeline_arguments = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, pipeline_arguments = argv[:split], argv[split + 1:]
+    parser = argparse.ArgumentParser(
+        description='Jet Curry synthetic jet benchmark',
+        epilog='arguments after -- are passed to JetCurryMain.py')
+    parser.add_argument('-out_dir', default='benchmark',
+                        help='directory for the synthetic images and results')
+    parser.add_argument('-cases', nargs='+', choices=sorted(CASES),
+                        default=sorted(CASES), help='cases to run (default: all)')
+    parser.add_argument('-jobs', type=int, default=JetCurryMain.cpu_count(),
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('-reference', action='store_true',
+                        help='also run every case at full resolution (-coarse 1) and '
+                        'report the difference')
+    parser.add_argument('-max_error', type=float,
+                        help='fail if the 3D RMS error of a case (and with '
+                        '-reference its 3D RMS difference from the full '
+                        'resolution run) is larger than this (pixels)')
+    parser.add_argument('-report',
+                        help='JSON report file (default: benchmark.json in -out_dir)')
+    return parser.parse_args(argv), pipeline_arguments
+
+
+def main():
+    args, pipeline_arguments = parse_arguments()
+    if args.report is None:
+        args.report = os.path.join(args.out_dir, 'benchmark.json')
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    cases = []
+    for name in args.cases:
+        report = run_case(name, CASES[name], JetCurryMain.THETA, args.out_dir,
+                          pipeline_arguments, args.jobs, args.reference)
+        cases.append(report)
+        if 'error' in report:
+            print('%-12s %s' % (name, report['error']))
+        else:
+            print('%-12s %4d samples %8.2f s %8.2f samples/s  '
+                  'rms 3d error %.3g  rms z error %.3g' % (
+                      name, report['samples'], report['wall_time'],
+                      report['samples_per_second'],
+                      report['errors']['rms_3d'],
+                      report['errors']['rms_z']))
+        if 'wall_time' in report.get('reference', {}):
+            print('%-12s full resolution %8.2f s  rms 3d error %.3g  '
+                  'rms 3d difference %.3g' % (
+                      '', report['reference']['wall_time'],
+                      report['reference']['errors']['rms_3d'],
+                      report['reference']['difference']['rms_3d']))
+        if args.max_error is not None:
+            report['failed'] = failed_checks(report, args.max_error)
+            for failure in report['failed']:
+                print('%-12s FAILED: %s' % ('', failure))
+
+    JetCurryMain.report_plots()
+    with open(args.report, 'w') as file:
+        json.dump({'theta': JetCurryMain.THETA, 'jobs': args.jobs,
+                   'max_error': args.max_error,
+                   'pipeline_arguments': pipeline_arguments,
+                   'cases': cases}, file, indent=2, sort_keys=True)
+    print('Report written to %s' % args.report)
+    if any(report.get('failed') for report in cases):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
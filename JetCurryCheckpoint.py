@@ -0,0 +1,72 @@
+'''
+Persistent per-sample results of the solver stages, used to resume a
+run that crashed or was stopped part way through.
+
+Every result is stored in its own small .npy file named after a hash of
+the stage function and all of its arguments (s, eta, theta, the
+previous stage's solution and the solver settings), so a result is
+only reused when the sample would be solved in exactly the same way.
+'''
+import os
+import hashlib
+import numpy as np
+
+
+def _Key_Repr(value):
+    '''
+    repr of a task argument that does not depend on the numpy version
+    '''
+    if isinstance(value, dict):
+        return '{' + ', '.join(_Key_Repr(k) + ': ' + _Key_Repr(value[k])
+                               for k in sorted(value)) + '}'
+    if isinstance(value, (list, tuple)):
+        return '(' + ', '.join(_Key_Repr(v) for v in value) + ')'
+    if isinstance(value, np.ndarray):
+        return _Key_Repr(value.tolist())
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    if isinstance(value, np.integer):
+        return repr(int(value))
+    return repr(value)
+
+
+class CheckpointStore():
+    '''
+    Directory of per-sample stage results
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, stage, arguments):
+        '''
+        Hash of a stage name and the arguments of one call
+        '''
+        text = stage + _Key_Repr(tuple(arguments))
+        return stage + '_' + hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+        Stored result of key, or None if the sample has not finished
+        '''
+        path = os.path.join(self.directory, key + '.npy')
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path)
+        except (IOError, ValueError):
+            # A partially written file from a killed run
+            return None
+
+    def put(self, key, result):
+        '''
+        Stores the result of key. The file is written under a temporary
+        name and renamed so that a crash never leaves a truncated result.
+        '''
+        path = os.path.join(self.directory, key + '.npy')
+        temporary = path + '.%d.tmp' % os.getpid()
+        with open(temporary, 'wb') as file:
+            np.save(file, np.asarray(result))
+        os.rename(temporary, path)
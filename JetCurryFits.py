@@ -0,0 +1,150 @@
+'''
+FITS file discovery and loading.
+
+The image of a file is the first HDU holding 2-D image data, so that
+multi-extension files with an empty primary HDU (e.g. drizzled products
+with a SCI extension) are read like simple ones. Files are validated
+from their headers only, and image data is memory-mapped so that pixels
+are only read from disk when a later stage touches them.
+'''
+import os
+import glob
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from astropy.io import fits
+
+
+def _is_image(hdu):
+    '''
+    True if the header of hdu describes a non-empty 2-D image
+    '''
+    header = hdu.header
+    return (hdu.is_image and header.get('NAXIS', 0) == 2 and
+            header.get('NAXIS1', 0) > 0 and header.get('NAXIS2', 0) > 0)
+
+
+def image_hdu(hdus):
+    '''
+    First HDU of an open HDUList that holds 2-D image data. Raises
+    ValueError if there is none.
+    '''
+    for hdu in hdus:
+        if _is_image(hdu):
+            return hdu
+    raise ValueError('no 2-D image in %s' % hdus.filename())
+
+
+def is_valid_fits(path):
+    '''
+    True if path is a FITS file with a 2-D image, see image_hdu, and
+    the file is long enough to hold all of its pixels. Only the
+    headers are read.
+    '''
+    try:
+        with fits.open(path, memmap=True) as hdus:
+            if not hdus[0].header.get('SIMPLE', False):
+                return False
+            hdu = image_hdu(hdus)
+            header = hdu.header
+            start = hdu.fileinfo()['datLoc']
+            compressed = isinstance(hdu, fits.CompImageHDU)
+    except Exception:
+        return False
+    if compressed:
+        # The pixels are stored in a table of another size
+        return True
+    size = (abs(header.get('BITPIX', 0)) // 8 *
+            header['NAXIS1'] * header['NAXIS2'])
+    return os.path.getsize(path) >= start + size
+
+
+def find_fits_files(input, jobs=8):
+    '''
+    Lists the FITS files to process
+
+    Arguments:
+        input : string
+            A single FITS file or a directory of *.fits files
+        jobs : int
+            Number of threads used to validate the headers of a directory
+
+    Returns:
+        valid : list
+            Paths of valid FITS files, in sorted order
+        invalid : list
+            Paths that are not valid FITS images
+    '''
+    if os.path.isfile(input):
+        paths = [input]
+    else:
+        paths = sorted(glob.glob(os.path.join(input, '*.fits')))
+    if len(paths) > 1 and jobs > 1:
+        pool = ThreadPool(min(jobs, len(paths)))
+        try:
+            checks = pool.map(is_valid_fits, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        checks = [is_valid_fits(path) for path in paths]
+    valid = [path for path, ok in zip(paths, checks) if ok]
+    invalid = [path for path, ok in zip(paths, checks) if not ok]
+    return valid, invalid
+
+
+def open_fits(path):
+    '''
+    Opens a FITS file with its images memory-mapped when the file
+    allows it. Scaled (BSCALE/BZERO) images are read into memory by
+    astropy. The image is image_hdu of the returned HDUList, which the
+    caller closes; that also releases the memory map.
+    '''
+    return fits.open(path, memmap=True)
+
+
+def load_fits_section(path, rows, columns):
+    '''
+    Part of the image of a FITS file, see image_hdu. Only the pixels
+    inside the section are read from disk.
+
+    Arguments:
+        path : string
+            FITS file
+        rows, columns : tuple
+            (start, stop) pixel range along y and x
+
+    Returns:
+        numpy array
+            Float image of (rows, columns)
+    '''
+    with fits.open(path, memmap=True) as hdus:
+        section = image_hdu(hdus).section[rows[0]:rows[1],
+                                          columns[0]:columns[1]]
+        return np.array(section, dtype=float)
+
+
+def bounding_box(shape, x, y, padding):
+    '''
+    Pixel range of the box around points x, y, padded on every side and
+    clipped to an image of shape (ny, nx)
+
+    Returns:
+        rows, columns : tuple
+            (start, stop) pixel range along y and x
+    '''
+    ny, nx = shape
+    rows = (max(0, int(np.floor(np.min(y))) - padding),
+            min(ny, int(np.ceil(np.max(y))) + padding + 1))
+    columns = (max(0, int(np.floor(np.min(x))) - padding),
+               min(nx, int(np.ceil(np.max(x))) + padding + 1))
+    return rows, columns
+
+
+def image_shape(path):
+    '''
+    (ny, nx) shape of the image of a FITS file, see image_hdu, from
+    its header
+    '''
+    with fits.open(path, memmap=True) as hdus:
+        header = image_hdu(hdus).header
+        return header['NAXIS2'], header['NAXIS1']
@@ -1,21 +1,170 @@
-import os
 try:
     import tkinter as tk # python 3
 except ImportError:
     import Tkinter as tk # python 2
+import numpy as np
+from collections import OrderedDict
 from PIL import Image, ImageTk
-from astropy.io import fits
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
+from matplotlib import cm
+import JetCurryFits
+
+# Edge of a rendered tile and largest size of the image view, in screen
+# pixels. The image is shown at 2**zoom screen pixels per image pixel.
+TILE = 256
+VIEW = 800
+MAX_ZOOM = 4
+# Largest edge of the sample used for the color scale
+OVERVIEW = 1024
+# Rows of the image read at a time to average a zoomed out tile, and
+# number of averaged tiles kept
+STRIP = 1024
+CACHE = 64
+
+
+def _block_mean(data):
+    '''
+    Mean of every 2 x 2 block of pixels, ignoring NaN. An odd last row
+    or column is averaged on its own. Blocks without data are NaN.
+    '''
+    ny, nx = data.shape
+    if ny % 2 or nx % 2:
+        padded = np.full((ny + ny % 2, nx + nx % 2), np.nan, dtype=np.float32)
+        padded[:ny, :nx] = data
+        data = padded
+    finite = np.isfinite(data)
+    values = np.where(finite, data, np.float32(0))
+    # Pairs of rows, then pairs of columns
+    total = values[0::2] + values[1::2]
+    total = total[:, 0::2] + total[:, 1::2]
+    count = finite[0::2].astype(np.uint8) + finite[1::2]
+    count = count[:, 0::2] + count[:, 1::2]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count.astype(np.float32)
+
+
+class ImagePyramid():
+    '''
+    Overview pyramid of an image, rendered tile by tile on demand
+
+    Zoom level -k shows the mean of every 2**k x 2**k block of pixels,
+    so faint extended emission stays visible when zoomed out. The means
+    of a tile are only computed when it is drawn, from its part of the
+    (memory-mapped) image read STRIP rows at a time, and the last CACHE
+    tiles are kept. Zoom levels from 0 up show the image itself.
+
+    Arguments:
+        data : numpy array
+            Image
+        colormap : matplotlib colormap
+    '''
+
+    def __init__(self, data, colormap=cm.viridis):
+        self.data = data
+        self.colormap = colormap
+        ny, nx = data.shape
+        step = max(1, max(ny, nx) // OVERVIEW)
+        sample = np.asarray(data[::step, ::step], dtype=float)
+        self.vmin = np.nanmin(sample) if np.isfinite(sample).any() else 0.0
+        self.vmax = np.nanmax(sample) if np.isfinite(sample).any() else 1.0
+        if self.vmax <= self.vmin:
+            self.vmax = self.vmin + 1.0
+        # The whole image fits in one tile at the smallest zoom
+        self.min_zoom = min(0, -int(np.ceil(np.log2(max(ny, nx) / float(TILE)))))
+        self.cache = OrderedDict()
+
+    def size(self, zoom):
+        '''
+        (width, height) of the image at zoom, in screen pixels
+        '''
+        ny, nx = self.data.shape
+        if zoom <= 0:
+            step = 2**-zoom
+            return -(-nx // step), -(-ny // step)
+        return nx * 2**zoom, ny * 2**zoom
+
+    def fit_zoom(self, width, height):
+        '''
+        Largest zoom at which the whole image fits in width x height
+        '''
+        zoom = MAX_ZOOM
+        while zoom > self.min_zoom:
+            w, h = self.size(zoom)
+            if w <= width and h <= height:
+                break
+            zoom -= 1
+        return zoom
+
+    def _block(self, zoom, tx, ty):
+        '''
+        Block means of tile (tx, ty) at zoom below 0, float32
+        '''
+        key = (zoom, tx, ty)
+        if key in self.cache:
+            # Most recently used last
+            self.cache[key] = self.cache.pop(key)
+            return self.cache[key]
+        scale = 2**-zoom
+        span = TILE * scale
+        ny, nx = self.data.shape
+        bottom = min(ny, (ty + 1) * span)
+        left, right = tx * span, min(nx, (tx + 1) * span)
+        # Whole blocks per strip, so that the strips average like the
+        # tile at once
+        rows = scale * max(1, STRIP // scale)
+        strips = []
+        for start in range(ty * span, bottom, rows):
+            block = np.asarray(self.data[start:min(bottom, start + rows),
+                                         left:right], dtype=np.float32)
+            for _ in range(-zoom):
+                block = _block_mean(block)
+            strips.append(block)
+        block = np.concatenate(strips)
+        self.cache[key] = block
+        if len(self.cache) > CACHE:
+            self.cache.popitem(last=False)
+        return block
+
+    def tile(self, zoom, tx, ty):
+        '''
+        RGBA uint8 array of tile (tx, ty) at zoom. Tiles at the right and
+        bottom edges are smaller than TILE.
+        '''
+        if zoom == 0:
+            block = self.data[ty * TILE:(ty + 1) * TILE,
+                              tx * TILE:(tx + 1) * TILE]
+        elif zoom < 0:
+            block = self._block(zoom, tx, ty)
+        else:
+            scale = 2**zoom
+            span = TILE // scale
+            block = self.data[ty * span:(ty + 1) * span,
+                              tx * span:(tx + 1) * span]
+            block = np.repeat(np.repeat(block, scale, axis=0), scale, axis=1)
+        normalized = ((np.asarray(block, dtype=float) - self.vmin) /
+                      (self.vmax - self.vmin))
+        return self.colormap(normalized, bytes=True)
+
+    def to_pixel(self, zoom, x, y):
+        '''
+        Full resolution (x, y) pixel at screen position x, y of the whole
+        image at zoom, clipped to the image
+        '''
+        ny, nx = self.data.shape
+        x = int(np.floor(x / 2.0**zoom))
+        y = int(np.floor(y / 2.0**zoom))
+        return min(max(x, 0), nx - 1), min(max(y, 0), ny - 1)
 
 
 class JetCurryGui():
     '''
     GUI to display FITS image to select regions of interest for jet
+
+    Only the tiles in view are rendered. Zoom with the mouse wheel or the
+    + and - keys, pan with the scrollbars, the arrow keys or by dragging
+    with Shift and the left mouse button.
     '''
 
-    def __init__(self, file):
+    def __init__(self, file, fits_data=None):
         self.gui = tk.Tk()
         self.gui.title('FITS Image')
         self.file = file
@@ -80,47 +229,173 @@ class JetCurryGui():
                 row=4,
                 column=3)
 
-        self.fits_data = fits.getdata(self.file)
-        plt.imsave('dummy.jpg', self.fits_data)
+        # Reuse the caller's (memory-mapped) image instead of reading
+        # the file a second time
+        self.hdus = None
+        if fits_data is None:
+            self.hdus = JetCurryFits.open_fits(self.file)
+            fits_data = JetCurryFits.image_hdu(self.hdus).data
+        self.fits_data = fits_data
+        self.pyramid = ImagePyramid(self.fits_data)
+        self.zoom = self.pyramid.fit_zoom(VIEW, VIEW)
+        # (tx, ty) -> (PhotoImage, canvas item) of the tiles on screen
+        self.tiles = {}
+
+        width, height = self.pyramid.size(self.zoom)
+        self.panel = tk.Canvas(
+            self.master_frame, width=min(width, VIEW),
+            height=min(height, VIEW), highlightthickness=0,
+            scrollregion=(0, 0, width, height),
+            xscrollincrement=TILE // 4, yscrollincrement=TILE // 4)
+        self.x_scrollbar = tk.Scrollbar(
+            self.master_frame, orient=tk.HORIZONTAL, command=self.scroll_x)
+        self.y_scrollbar = tk.Scrollbar(
+            self.master_frame, orient=tk.VERTICAL, command=self.scroll_y)
+        self.panel.configure(xscrollcommand=self.x_scrollbar.set,
+                             yscrollcommand=self.y_scrollbar.set)
+        self.panel.grid(row=1, column=0)
+        self.x_scrollbar.grid(row=2, column=0, sticky='ew')
+        self.y_scrollbar.grid(row=1, column=1, sticky='ns')
 
-        self.img = Image.open('dummy.jpg')
-        self.photo = ImageTk.PhotoImage(self.img)
-        self.panel = tk.Label(self.master_frame, image=self.photo)
         self.clicks = list(range(2))
         # Left mouse click for upstream (start)
         self.panel.bind('<Button-1>', self.get_start_point)
-        # Right mouse click for downstream (end)
+        # Right mouse click for downstream (end), Button-2 on macOS
         self.panel.bind('<Button-2>', self.get_end_point)
-        self.panel.grid(row=1, column=0)
+        self.panel.bind('<Button-3>', self.get_end_point)
+        self.panel.bind('<Shift-Button-1>', self.start_pan)
+        self.panel.bind('<Shift-B1-Motion>', self.pan)
+        self.panel.bind('<MouseWheel>', self.wheel)
+        self.panel.bind('<Button-4>', self.wheel)
+        self.panel.bind('<Button-5>', self.wheel)
+        self.panel.bind('<Configure>', lambda event: self.draw_tiles())
+        self.gui.bind('<plus>', lambda event: self.zoom_by(1))
+        self.gui.bind('<equal>', lambda event: self.zoom_by(1))
+        self.gui.bind('<minus>', lambda event: self.zoom_by(-1))
+        for key, x, y in (('Left', -1, 0), ('Right', 1, 0),
+                          ('Up', 0, -1), ('Down', 0, 1)):
+            self.gui.bind('<%s>' % key,
+                          lambda event, x=x, y=y: self.scroll_by(x, y))
+
+        try:
+            self.gui.mainloop()
+        finally:
+            if self.hdus is not None:
+                self.hdus.close()
+
+    def draw_tiles(self):
+        '''
+        Renders the tiles in view and drops those out of view
+        '''
+        left = int(self.panel.canvasx(0))
+        top = int(self.panel.canvasy(0))
+        right = left + self.panel.winfo_width()
+        bottom = top + self.panel.winfo_height()
+        width, height = self.pyramid.size(self.zoom)
+        visible = set(
+            (tx, ty)
+            for tx in range(max(0, left // TILE),
+                            min(-(-width // TILE), right // TILE + 1))
+            for ty in range(max(0, top // TILE),
+                            min(-(-height // TILE), bottom // TILE + 1)))
+        for key in list(self.tiles):
+            if key not in visible:
+                self.panel.delete(self.tiles.pop(key)[1])
+        for tx, ty in visible.difference(self.tiles):
+            photo = ImageTk.PhotoImage(
+                Image.fromarray(self.pyramid.tile(self.zoom, tx, ty)))
+            item = self.panel.create_image(
+                tx * TILE, ty * TILE, image=photo, anchor=tk.NW)
+            self.tiles[(tx, ty)] = (photo, item)
+
+    def set_zoom(self, zoom, x, y):
+        '''
+        Changes the zoom, keeping the image pixel at window position
+        x, y in place
+        '''
+        zoom = min(MAX_ZOOM, max(self.pyramid.min_zoom, zoom))
+        if zoom == self.zoom:
+            return
+        factor = 2.0**(zoom - self.zoom)
+        anchor_x = self.panel.canvasx(x) * factor
+        anchor_y = self.panel.canvasy(y) * factor
+        self.zoom = zoom
+        for photo, item in self.tiles.values():
+            self.panel.delete(item)
+        self.tiles = {}
+        width, height = self.pyramid.size(zoom)
+        self.panel.configure(scrollregion=(0, 0, width, height))
+        self.panel.xview_moveto((anchor_x - x) / width)
+        self.panel.yview_moveto((anchor_y - y) / height)
+        self.draw_tiles()
 
-        os.remove('dummy.jpg')
+    def zoom_by(self, step):
+        '''
+        Zooms in (step > 0) or out around the middle of the view
+        '''
+        self.set_zoom(self.zoom + step, self.panel.winfo_width() // 2,
+                      self.panel.winfo_height() // 2)
+
+    def wheel(self, event):
+        '''
+        Zooms around the mouse position
+        '''
+        if event.num == 4 or getattr(event, 'delta', 0) > 0:
+            self.set_zoom(self.zoom + 1, event.x, event.y)
+        else:
+            self.set_zoom(self.zoom - 1, event.x, event.y)
+
+    def scroll_x(self, *args):
+        self.panel.xview(*args)
+        self.draw_tiles()
 
-        self.gui.mainloop()
+    def scroll_y(self, *args):
+        self.panel.yview(*args)
+        self.draw_tiles()
+
+    def scroll_by(self, x, y):
+        self.panel.xview_scroll(x, 'units')
+        self.panel.yview_scroll(y, 'units')
+        self.draw_tiles()
+
+    def start_pan(self, event):
+        self.panel.scan_mark(event.x, event.y)
+
+    def pan(self, event):
+        self.panel.scan_dragto(event.x, event.y, gain=1)
+        self.draw_tiles()
+
+    def get_pixel(self, event):
+        '''
+        Full resolution pixel of a mouse click
+        '''
+        return self.pyramid.to_pixel(self.zoom, self.panel.canvasx(event.x),
+                                     self.panel.canvasy(event.y))
 
     def get_start_point(self, event):
         '''
         Get and display button clicks on image as upstream
         '''
-        self.clicks[0:2] = event.x, event.y
+        self.clicks[0:2] = self.get_pixel(event)
         self.x_start_entry.delete(0, tk.END)
         self.x_start_entry.insert(0, self.clicks[0])
         self.y_start_entry.delete(0, tk.END)
         self.y_start_entry.insert(0, self.clicks[1])
         self.start_pixel_value_label.configure(
-            text=self.fits_data[event.y - 1, event.x - 1])
+            text=self.fits_data[self.clicks[1], self.clicks[0]])
         self.start_pixel_value_label.grid(row=2, column=3)
 
     def get_end_point(self, event):
         '''
         Get and display button clicks on image as downstream
         '''
-        self.clicks[0:2] = event.x, event.y
+        self.clicks[0:2] = self.get_pixel(event)
         self.x_end_entry.delete(0, tk.END)
         self.x_end_entry.insert(0, self.clicks[0])
         self.y_end_entry.delete(0, tk.END)
         self.y_end_entry.insert(0, self.clicks[1])
         self.end_pixel_value_label.configure(
-            text=self.fits_data[event.y - 1, event.x - 1])
+            text=self.fits_data[self.clicks[1], self.clicks[0]])
         self.end_pixel_value_label.grid(row=3, column=3)
 
     def close_gui(self):
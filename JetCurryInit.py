@@ -7,7 +7,7 @@ if pythonVersion == 3:
 else:
   tk = "Tkinter"
 
-def check_modules():
+def check_modules(gui=True):
   # Required modules
   modules = ['emcee',
             'multiprocessing',
@@ -21,8 +21,11 @@ def check_modules():
             'argparse',
             'glob',
             'PIL',
-            'itertools',
-            tk]
+            'itertools']
+
+  # Tk is only needed to select the bounds interactively
+  if gui:
+    modules.append(tk)
 
   '''
   Try to import required modules.
@@ -1,51 +1,200 @@
+'''
+Logging of a Jet Curry run.
+
+Every log file gets one logger, configured the first time it is opened.
+Messages are put on a queue and written to the file (and the console
+with -debug) by a listener thread, so logging never waits on disk.
+Worker processes log through the same queue, see worker_log_queue.
+
+Log arguments are only formatted if the message is emitted, and numpy
+arrays are best passed through summarize, which logs large arrays as
+their shape and statistics instead of every value.
+'''
 import sys
+import atexit
 import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
+import numpy as np
+
+FORMAT = "%(asctime)s - %(levelname)s: %(message)s"
+
+# Arrays with more elements than this are logged as a summary
+FULL_ARRAY_SIZE = 64
+
+# Logger of the per-sample tasks, in the worker processes and in the
+# main process when tasks run there
+WORKER_LOGGER = 'JetCurry.worker'
+
+# Listener, queue and level of every open log file
+_logs = {}
+# Queue and level of the log file opened last in this process
+_current = None
+
+
+class ArraySummary():
+	'''
+	Log argument that formats a numpy array when the message is emitted:
+	every value for small arrays, otherwise the shape, dtype, NaN count
+	and min/mean/max
+	'''
+
+	def __init__(self, array):
+		self.array = array
+
+	def __str__(self):
+		array = np.asarray(self.array)
+		if array.size <= FULL_ARRAY_SIZE:
+			return np.array2string(array, max_line_width=120)
+		summary = 'array(shape=%s, dtype=%s' % (array.shape, array.dtype)
+		if np.issubdtype(array.dtype, np.number):
+			finite = array[np.isfinite(array)]
+			summary += ', nan=%d' % (array.size - finite.size)
+			if finite.size:
+				summary += ', min=%.6g, mean=%.6g, max=%.6g' % (
+					finite.min(), finite.mean(), finite.max())
+		return summary + ')'
+
+
+def summarize(array):
+	'''
+	Lazily formatted summary of a numpy array for a log message
+	'''
+	return ArraySummary(array)
+
+
+def open_log(logfile, debug=False):
+	'''
+	Logger of a log file. It is configured the first time the log file
+	is opened: a queue handler, and a listener thread writing to the
+	file and, with debug, to the console. Debug messages are only
+	emitted with debug.
+
+	The worker logger of this process is pointed at the same queue.
+	'''
+	global _current
+	logger = logging.getLogger('JetCurry.' + logfile)
+	if logfile not in _logs:
+		formatter = logging.Formatter(FORMAT)
+		handlers = [logging.FileHandler(logfile)]
+		if (debug is True or debug == 'True'):
+			handlers.append(logging.StreamHandler(sys.stdout))
+		for handler in handlers:
+			handler.setFormatter(formatter)
+		queue = multiprocessing.Queue(-1)
+		listener = QueueListener(queue, *handlers)
+		listener.start()
+		level = logging.DEBUG if len(handlers) > 1 else logging.INFO
+		_logs[logfile] = (listener, queue, level)
+
+		for handler in list(logger.handlers):
+			logger.removeHandler(handler)
+		logger.addHandler(QueueHandler(queue))
+		logger.setLevel(level)
+		logger.propagate = False
+
+	_, queue, level = _logs[logfile]
+	_current = (queue, level)
+	attach_worker(queue, level)
+	return logger
+
+
+def worker_log_queue():
+	'''
+	(queue, level) of the log file opened last in this process, for
+	attach_worker in worker processes, or None
+	'''
+	return _current
+
+
+def attach_worker(queue, level):
+	'''
+	Sends the messages of the worker logger of this process to queue
+	'''
+	logger = logging.getLogger(WORKER_LOGGER)
+	for handler in list(logger.handlers):
+		logger.removeHandler(handler)
+	logger.addHandler(QueueHandler(queue))
+	logger.setLevel(level)
+	logger.propagate = False
+
+
+class RecordBuffer(QueueHandler):
+	'''
+	Keeps the records of a logger in memory, prepared like those of a
+	QueueHandler so that they can be pickled, see buffer_worker
+	'''
+
+	def __init__(self):
+		QueueHandler.__init__(self, None)
+		self.records = []
+
+	def enqueue(self, record):
+		self.records.append(record)
+
+
+def buffer_worker():
+	'''
+	Collects every message of the worker logger of this process in a
+	RecordBuffer, for workers that cannot reach the queue of the log
+	file, e.g. those of a JetCurryQueue on another machine. The records
+	are written to the log file by replay_worker in the process that
+	has it open.
+
+	Returns:
+		RecordBuffer
+	'''
+	buffer = RecordBuffer()
+	logger = logging.getLogger(WORKER_LOGGER)
+	for handler in list(logger.handlers):
+		logger.removeHandler(handler)
+	logger.addHandler(buffer)
+	logger.setLevel(logging.DEBUG)
+	logger.propagate = False
+	return buffer
+
+
+def replay_worker(records):
+	'''
+	Logs records of a RecordBuffer through the worker logger of this
+	process, at its level
+	'''
+	logger = logging.getLogger(WORKER_LOGGER)
+	for record in records:
+		if logger.isEnabledFor(record.levelno):
+			logger.handle(record)
+
+
+def close_log(logfile):
+	'''
+	Writes the queued messages of a log file and closes it once its
+	FITS file is finished
+	'''
+	global _current
+	if logfile not in _logs:
+		return
+	listener, queue, _ = _logs.pop(logfile)
+	listener.stop()
+	for handler in listener.handlers:
+		handler.close()
+	queue.close()
+	if _current is not None and _current[0] is queue:
+		_current = None
+		logger = logging.getLogger(WORKER_LOGGER)
+		for handler in list(logger.handlers):
+			logger.removeHandler(handler)
+	logger = logging.getLogger('JetCurry.' + logfile)
+	for handler in list(logger.handlers):
+		logger.removeHandler(handler)
+
+
+def close_all_logs():
+	'''
+	Closes every open log file, so that no queued message is lost when
+	a run stops early
+	'''
+	for logfile in list(_logs):
+		close_log(logfile)
+
 
-pythonVersion = sys.version_info[0]
-
-def write_log(logfile, logLevel, message, logMode):
-	FORMAT = "%(asctime)s - %(levelname)s: %(message)s"
-	if pythonVersion == 3:
-		if (logMode is True or logMode == 'True'):
-			logging.basicConfig(
-    			level=logging.INFO,
-    			format=FORMAT,
-    			handlers=[
-        			logging.FileHandler(logfile),
-        			logging.StreamHandler(sys.stdout)
-    			])
-		else:
-			logging.basicConfig(
-                        level=logging.INFO,
-                        format=FORMAT,
-                        handlers=[
-							logging.FileHandler(logfile)
-			])
-
-		logger = logging.getLogger()
-		if logLevel == 'info':
-			logger.info(message)
-		elif logLevel =='critical':
-			logger.critical(message)
-		else:
-			logger.error(message)
-	else:
-		logger = logging.getLogger()
-		logFormatter = logging.Formatter(FORMAT)
-		logger.setLevel(logging.INFO)
-
-		fileHandler = logging.FileHandler(logfile)
-		fileHandler.setFormatter(logFormatter)
-		logger.addHandler(fileHandler)
-
-		if (logMode is True or logMode == 'True'):
-			consoleHandler = logging.StreamHandler(sys.stdout)
-			consoleHandler.setFormatter(logFormatter)
-			logger.addHandler(consoleHandler)
-
-		if logLevel == 'info':
-			logger.info(message)
-		elif logLevel =='critical':
-			logger.critical(message)
-		else:
-			logger.error(message)
+atexit.register(close_all_logs)
@@ -22,239 +22,537 @@ import os
 import JetCurryInit
 
 # Prints any missing modules and exits. Otherwise, continue.
-requiredModules = JetCurryInit.check_modules()
+# The GUI modules are checked later, and only if the GUI is used.
+requiredModules = JetCurryInit.check_modules(gui=False)
 if requiredModules:
     print('Module(s) ' + ', '.join(requiredModules) + ' not installed')
     os.sys.exit()
 
-from astropy.io import fits
 import numpy as np
 import matplotlib
 matplotlib.use("Agg")
-import matplotlib.pyplot as plt
 import JetCurry as jet
 import argparse
-import glob
-import JetCurryGui
-from JetCurryLogger import write_log
+from JetCurryLogger import open_log, close_log, close_all_logs, summarize
 import itertools
+from JetCurryCheckpoint import CheckpointStore
+from JetCurryMetrics import RunMetrics
+import JetCurryTargets
+import JetCurryFits
+import JetCurryResults
+import JetCurryPlots
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor
 
 
-# Create command line argument parser
-parser = argparse.ArgumentParser(description="Jet Curry")
-parser.add_argument('input', help='file or folder name')
-parser.add_argument('-out_dir', help='output directory path')
-parser.add_argument('-debug', help='console logger', action='store_true')
-args = parser.parse_args()
+np.seterr(all='ignore')
+# Line of Sight (radians)
+THETA = 0.261799388
+# Pixels read around the bounds of the jet
+ROI_PADDING = 50
 
-'''
-Determine whether input is a single file or directory
-Create list of FITS files for processing
-'''
-files = []
-if os.path.isfile(args.input):
-    try:
-        fits.PrimaryHDU.readfrom(args.input)
-        files.append(args.input)
-    except BaseException:
-        print('%s is not a valid FITS file!' % args.input)
-        os.sys.exit()
-else:
-    if os.path.exists(args.input):
-        for file in glob.glob(args.input + '/*.fits'):
-            try:
-                fits.PrimaryHDU.readfrom(file)
-                files.append(file)
-            except BaseException:
-                print('%s is not a valid FITS file!' % file)
-    else:
+
+def parse_arguments(argv=None):
+    '''
+    Create command line argument parser
+    argv defaults to the command line arguments
+    '''
+    parser = argparse.ArgumentParser(description="Jet Curry")
+    parser.add_argument('input', help='file or folder name')
+    parser.add_argument('-out_dir', help='output directory path')
+    parser.add_argument('-debug', help='console logger', action='store_true')
+    parser.add_argument('-jobs', type=int, default=cpu_count(),
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('-file_jobs', type=int, default=1,
+                        help='number of FITS files processed at the same time; '
+                        '-jobs worker processes are shared between them')
+    parser.add_argument('-queue',
+                        help='shared work queue directory; per-sample tasks are run by '
+                        'JetCurryWorker.py processes instead of local workers')
+    parser.add_argument('-adaptive', action='store_true',
+                        help='stop the MCMC stages once the best solution stops improving')
+    parser.add_argument('-max_steps', type=int,
+                        default=jet.ADAPTIVE_SETTINGS['max_steps'],
+                        help='most MCMC steps per sample with -adaptive (default: %(default)s)')
+    parser.add_argument('-tolerance', type=float,
+                        default=jet.ADAPTIVE_SETTINGS['tolerance'],
+                        help='smallest improvement of the best log-probability that keeps '
+                        'an -adaptive run going (default: %(default)s)')
+    parser.add_argument('-hypercube', action='store_true',
+                        help='start the MCMC stages from the best points of a Latin '
+                        'hypercube instead of a fixed grid of 1024 walkers')
+    parser.add_argument('-walkers', type=int,
+                        default=jet.SEED_SETTINGS['walkers'],
+                        help='number of walkers with -hypercube (default: %(default)s)')
+    parser.add_argument('-warm', action='store_true',
+                        help='seed the broad MCMC search of each sample from the '
+                        'solution of the previous sample along the jet')
+    parser.add_argument('-warm_length', type=int,
+                        default=jet.WARM_SETTINGS['length'],
+                        help='samples per warm-started chain; chains run in parallel '
+                        '(default: %(default)s)')
+    parser.add_argument('-coarse', type=int, default=1, metavar='N',
+                        help='give only every Nth sample the full MCMC search and '
+                        'refine the others from interpolated solutions (default: 1, off)')
+    parser.add_argument('-text', action='store_true',
+                        help='also export the results as tab separated text files')
+    parser.add_argument('-posterior', action='store_true',
+                        help='keep posterior draws of the MCMC2 stage and report '
+                        'percentile bands of the Cartesian coordinates')
+    parser.add_argument('-burn', type=int,
+                        default=jet.POSTERIOR_SETTINGS['burn'],
+                        help='MCMC steps discarded before draws are kept with '
+                        '-posterior (default: %(default)s)')
+    parser.add_argument('-thin', type=int,
+                        default=jet.POSTERIOR_SETTINGS['thin'],
+                        help='keep every Nth MCMC step with -posterior (default: %(default)s)')
+    parser.add_argument('-draws', type=int,
+                        default=jet.POSTERIOR_SETTINGS['draws'],
+                        help='posterior draws stored per sample with -posterior '
+                        '(default: %(default)s)')
+    parser.add_argument('-roi_padding', type=int, default=ROI_PADDING,
+                        help='pixels of image read around the bounds; the ridge is '
+                        'searched inside this region (default: %(default)s)')
+    parser.add_argument('-smoothing', type=float,
+                        help='smooth the ridge with this penalty instead of fitting a '
+                        'spline through every column')
+    parser.add_argument('-no_plots', action='store_true',
+                        help='do not draw the contour and simulation plots')
+    parser.add_argument('-plot_dpi', type=int, default=JetCurryPlots.DPI,
+                        help='resolution of the plots (default: %(default)s)')
+    parser.add_argument('-profile', action='store_true',
+                        help='write a cProfile dump of every solver stage next to the log')
+    parser.add_argument('-resume', action='store_true',
+                        help='reuse the existing output directory and skip finished samples')
+    parser.add_argument('-targets',
+                        help='CSV or JSON file of bounds per FITS file; runs without the GUI')
+    parser.add_argument('-upstream', type=int, nargs=2, metavar=('X', 'Y'),
+                        help='upstream bound for every file; runs without the GUI')
+    parser.add_argument('-downstream', type=int, nargs=2, metavar=('X', 'Y'),
+                        help='downstream bound for every file; runs without the GUI')
+    args = parser.parse_args(argv)
+    if (args.upstream is None) != (args.downstream is None):
+        parser.error('-upstream and -downstream must be given together')
+    if args.max_steps < 1:
+        parser.error('-max_steps must be at least 1')
+    # emcee's moves need more than two walkers per parameter, and the
+    # walkers are picked from the points of the hypercube
+    if not 10 < args.walkers <= jet.SEED_SETTINGS['points']:
+        parser.error('-walkers must be more than 10 and at most %d' %
+                     jet.SEED_SETTINGS['points'])
+    return args
+
+
+def find_files(input, jobs):
+    '''
+    Determine whether input is a single file or directory
+    Create list of FITS files for processing
+    Only the FITS headers are read, in parallel for a directory
+    '''
+    if not os.path.exists(input):
         print('Input directory does not exist!')
+        return []
+    files, invalid = JetCurryFits.find_fits_files(input, jobs)
+    for file in invalid:
+        print('%s is not a valid FITS file!' % file)
+    if os.path.isfile(input) and invalid:
+        os.sys.exit()
+    return files
 
-# Create output directory if it doesn't exitst
-if args.out_dir is not None:
-    if not os.path.exists(args.out_dir):
-        try:
-            os.makedirs(args.out_dir)
-        except BaseException:
-            print('%s does not exist and cannot be created' % args.out_dir)
-else:
-    args.out_dir = os.getcwd()
 
-if args.out_dir[-1] == '/':
-    output_directory_default = args.out_dir
-else:
-    output_directory_default = args.out_dir + '/'
+def select_bounds(file, args, targets):
+    '''
+    Upstream and downstream bounds of a FITS file, and its image data.
+    Bounds come from -upstream/-downstream, the -targets file or, if
+    neither is given, the GUI. Tk is only imported for the GUI.
+    Returns None if the file is not listed in the targets file.
+    '''
+    if args.upstream is not None:
+        return np.array(args.upstream), np.array(args.downstream)
+
+    if targets is not None:
+        return JetCurryTargets.lookup_bounds(targets, file)
+
+    missing_modules = JetCurryInit.check_modules(gui=True)
+    if missing_modules:
+        print('Module(s) ' + ', '.join(missing_modules) + ' not installed')
+        os.sys.exit()
+    import JetCurryGui
+    curry = JetCurryGui.JetCurryGui(file)
+    upstream_bounds = np.array(
+        [curry.x_start_variable.get(), curry.y_start_variable.get()])
+    downstream_bounds = np.array(
+        [curry.x_end_variable.get(), curry.y_end_variable.get()])
+    return upstream_bounds, downstream_bounds
 
-np.seterr(all='ignore')
-S = []
-ETA = []
-# Line of Sight (radians)
-THETA = 0.261799388
 
-for file in files:
+def process_file(file, upstream_bounds, downstream_bounds,
+                 output_directory_default, args, jobs):
+    '''
+    Run the Jet Curry pipeline on a single FITS file
+    jobs is the number of worker processes of the per-sample stages
+    Returns the output directory and the wall time (seconds) of each
+    stage, or None if the image cannot be read
+    '''
+    # Stage and per-sample metrics, written next to the log. The
+    # progress line is only shown when one file runs at a time.
+    metrics = RunMetrics(profile=args.profile,
+                         progress=args.file_jobs == 1 and os.sys.stderr.isatty())
+    metrics.start_stage('load')
+    # Only the region around the jet is read, so that memory and time
+    # depend on the length of the jet and not on the size of the image.
+    # origin is the full image pixel of the first pixel of the region.
+    # A file that cannot be read is reported and skipped, like the
+    # invalid files of find_files, instead of stopping the batch
+    try:
+        rows, columns = JetCurryFits.bounding_box(
+            JetCurryFits.image_shape(file),
+            [upstream_bounds[0], downstream_bounds[0]],
+            [upstream_bounds[1], downstream_bounds[1]], args.roi_padding)
+        fits_data = JetCurryFits.load_fits_section(file, rows, columns)
+    except Exception as e:
+        print('%s could not be read: %s' % (file, e))
+        return None
+    origin = np.array([columns[0], rows[0]])
+
     filename = os.path.splitext(file)[0]
     filename = os.path.basename(filename)
     output_directory = output_directory_default + filename + '/'
 
     # create output directory
     # if directory already exists, append name with _N
+    # when resuming, reuse the most recent existing directory instead
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
     else:
         for i in itertools.count(1):
+            previous_directory = output_directory
             output_directory = output_directory_default + filename + '_' + str(i) + '/'
             if not os.path.exists(output_directory):
-                os.makedirs(output_directory)
+                if args.resume:
+                    output_directory = previous_directory
+                else:
+                    os.makedirs(output_directory)
                 break
 
+    # Finished samples of every stage are kept here so that -resume
+    # only recomputes the samples that are missing
+    checkpoint = CheckpointStore(output_directory + 'checkpoints/')
+
     # create log file
     log_filename = output_directory + filename + '.log'
+    log = open_log(log_filename, args.debug)
 
-    curry = JetCurryGui.JetCurryGui(file)
-    upstream_bounds = np.array(
-        [curry.x_start_variable.get(), curry.y_start_variable.get()])
-    downstream_bounds = np.array(
-        [curry.x_end_variable.get(), curry.y_end_variable.get()])
+    log.info('Using filename: %s.fits', filename)
+    log.info('Output directory set to %s', output_directory)
+    log.info('Upstream bound is: %s', upstream_bounds)
+    log.info('Downstream bound is: %s', downstream_bounds)
+    log.info('Region of interest: x %s:%s, y %s:%s', columns[0], columns[1],
+             rows[0], rows[1])
 
-    if (not np.any(upstream_bounds) or not np.any(downstream_bounds)):
-        print('Please select upstream and downstream bounds')
-        os.sys.exit()
+    # Adaptive stopping, seeding and warm-start settings of the MCMC
+    # stages, None for the fixed defaults
+    adaptive = None
+    if args.adaptive:
+        adaptive = {'max_steps': args.max_steps, 'tolerance': args.tolerance}
+    seed = None
+    if args.hypercube:
+        seed = {'walkers': args.walkers}
+    warm = None
+    if args.warm:
+        warm = {'length': args.warm_length}
+    posterior = None
+    if args.posterior:
+        # draws is part of the checkpoint key of every MCMC2 sample, so
+        # that a resumed run with another -draws solves them again
+        # instead of leaving the rows of the resized store empty
+        posterior = {'burn': args.burn, 'thin': args.thin,
+                     'draws': args.draws}
+
+    # Every data product goes into one results file. Tables are
+    # appended as soon as each stage finishes.
+    results_path = output_directory + filename + '_results.fits'
+    JetCurryResults.create_results(
+        results_path, filename + '.fits', upstream_bounds, downstream_bounds,
+        THETA, {'adaptive': adaptive, 'seed': seed, 'warm': warm,
+                'smoothing': args.smoothing, 'coarse': args.coarse,
+                'posterior': posterior and dict(posterior, draws=args.draws)},
+        input_path=file)
+    metrics.end_stage()
 
-    write_log(log_filename, 'info', 'Using filename: ' + filename + '.fits', args.debug)
-    write_log(log_filename, 'info', 'Output directory set to ' + output_directory, args.debug)
-    write_log(log_filename, 'info', 'Upstream bound is: ' + str(upstream_bounds), args.debug)
-    write_log(log_filename, 'info', 'Downstream bound is: ' + str(downstream_bounds), args.debug)
-    
-    pixel_min = np.nanmin(curry.fits_data)
-    pixel_max = np.nanmax(curry.fits_data)
+    metrics.start_stage('scale')
+    # Scaled to the range of the region
+    pixel_min = np.nanmin(fits_data)
+    pixel_max = np.nanmax(fits_data)
 
     # Square Root Scaling for fits image
     try:
-        data = jet.imagesqrt(curry.fits_data, pixel_min, pixel_max)
+        data = jet.imagesqrt(fits_data, pixel_min, pixel_max)
     except Exception as e:
-        write_log(log_filename, 'critical', 'Failed to create square root image of data:', args.debug)
-        write_log(log_filename, 'critical', e, args.debug)
+        log.critical('Failed to create square root image of data: %s', e)
         os.sys.exit()
     else:
-        write_log(log_filename, 'info', 'Created square root image of data:', args.debug)
-        write_log(log_filename, 'info', str(data) + '\n', args.debug)
+        log.info('Created square root image of data: %s', summarize(data))
 
     number_of_points = downstream_bounds[0] - upstream_bounds[0]
     if number_of_points > 0:
-        write_log(log_filename, 'info', 'Number of sample points: ' +  str(number_of_points), args.debug)
+        log.info('Number of sample points: %s', number_of_points)
     else:
-        write_log(log_filename, 'critical', 'The number of sample points must be positive: ' + str(number_of_points), args.debug)
+        log.critical('The number of sample points must be positive: %s', number_of_points)
         os.sys.exit()
+    metrics.end_stage()
 
-    plt.imshow(data)
-
-    # Go column by column to calculate the max flux for each column
+    metrics.start_stage('ridge')
+    # Go column by column to calculate the max flux for each column.
+    # The ridge is found in region coordinates and moved back to full
+    # image pixels.
     try:
         x, y, x_smooth, y_smooth, intensity_max = jet.Find_MaxFlux(
-            data, upstream_bounds, downstream_bounds, number_of_points)
+            data, upstream_bounds - origin, downstream_bounds - origin,
+            number_of_points, smoothing=args.smoothing)
     except Exception as e:
-        write_log(log_filename, 'critical', 'Failed to calculate the max intensity:', args.debug)
-        write_log(log_filename, 'critical', e , args.debug)
+        log.critical('Failed to calculate the max intensity: %s', e)
         os.sys.exit()
     else:
-        write_log(log_filename, 'info', 'Successfully calculated the max intensities', args.debug)
-        write_log(log_filename, 'info', 'Max intensity at point x:', args.debug)
-        write_log(log_filename, 'info', str(x) + '\n', args.debug)
-        write_log(log_filename, 'info', 'Max intensity at point y:', args.debug)
-        write_log(log_filename, 'info', str(y) + '\n', args.debug)
-        write_log(log_filename, 'info', 'Smoothed sample points calculated over the start/stop interval:', args.debug)
-        write_log(log_filename, 'info', str(x_smooth) + '\n', args.debug)
-        write_log(log_filename, 'info', 'Interpolated curve using spline fit:', args.debug)
-        write_log(log_filename, 'info', str(y_smooth) + '\n', args.debug)
-        write_log(log_filename, 'info', 'Max intensity at each column:', args.debug)
-        write_log(log_filename, 'info', str(intensity_max) + '\n', args.debug)
-
-    # Plot the Max Flux over the Image
-    plt.contour(data, 10, cmap='gray')
-    plt.scatter(x_smooth, y_smooth, c='b')
-    plt.scatter(x, y, c='b')
-    plt.title('Outline of Jet Stream')
-    ax = plt.gca()
-    ax.invert_yaxis()
-    # plt.show()
-    plt.savefig(output_directory + filename + '_contour.png')
-    plt.clf()
+        x = x + origin[0]
+        x_smooth = x_smooth + origin[0]
+        y = y + origin[1]
+        y_smooth = y_smooth + origin[1]
+        log.info('Successfully calculated the max intensities')
+        log.info('Max intensity at point x: %s', summarize(x))
+        log.info('Max intensity at point y: %s', summarize(y))
+        log.info('Smoothed sample points calculated over the start/stop interval: %s', summarize(x_smooth))
+        log.info('Interpolated curve using spline fit: %s', summarize(y_smooth))
+        log.info('Max intensity at each column: %s', summarize(intensity_max))
+        JetCurryResults.append_ridge(results_path, x, y, intensity_max)
+
+    metrics.end_stage()
 
+    metrics.start_stage('s_eta')
     # Calculate the s and eta values
     # s,eta, x_smooth,y_smooth values will
-    # be stored in parameters.txt file
+    # be stored in the PARAMETERS table of the results file
     try:
-        S, ETA = jet.Calculate_s_and_eta(
-            x_smooth, y_smooth, upstream_bounds, output_directory, filename)
+        S, ETA = jet.Calculate_s_and_eta(x_smooth, y_smooth, upstream_bounds)
     except Exception as e:
-        write_log(log_filename, 'critical', 'Failed to calculate S and ETA:', args.debug)
-        write_log(log_filename, 'critical', e, args.debug)
+        log.critical('Failed to calculate S and ETA: %s', e)
     else:
-        write_log(log_filename, 'info', 'Calculated S:', args.debug)
-        write_log(log_filename, 'info', str(S) + '\n', args.debug)
-        write_log(log_filename, 'info', 'Calculated ETA:', args.debug)
-        write_log(log_filename, 'info', str(ETA) + '\n', args.debug)
+        log.info('Calculated S: %s', summarize(S))
+        log.info('Calculated ETA: %s', summarize(ETA))
+        JetCurryResults.append_parameters(results_path, S, ETA, x_smooth, y_smooth)
+    metrics.end_stage()
 
     # Run the First MCMC Trial in Parallel
+    # With -coarse only the coarse samples get the MCMC stages, the
+    # others are refined from them in the refine stage
+    samples = None
+    if args.coarse > 1:
+        samples = jet.Coarse_Samples(len(S), args.coarse)
+        log.info('Coarse-to-fine: full search of %s of %s samples',
+                 len(samples), len(S))
+    metrics.start_stage('MCMC1')
     try:
-        jet.MCMC1_Parallel(S, ETA, THETA, output_directory, filename)
+        mcmc1 = jet.MCMC1_Parallel(S, ETA, THETA, jobs=jobs,
+            checkpoint=checkpoint, queue=args.queue, adaptive=adaptive,
+            seed=seed, warm=warm, metrics=metrics, samples=samples)
     except Exception as e:
-        write_log(log_filename, 'critical', 'MCMC1_Parallel failed:', args.debug)
-        write_log(log_filename, 'critical', e, args.debug)
+        log.critical('MCMC1_Parallel failed: %s', e)
         os.sys.exit()
     else:
-        write_log(log_filename, 'info', 'MCM1_Parallel passed', args.debug)
+        log.info('MCM1_Parallel passed')
+        log.info('MCMC1 steps per sample: %s', summarize(mcmc1['steps']))
+        JetCurryResults.append_table(results_path, 'MCMC1', mcmc1)
+    metrics.end_stage()
 
+    # Posterior draws of the MCMC2 stage come back with the sample
+    # results and are written to a memory-mapped file, one row per sample
+    if posterior is not None:
+        posterior['path'] = os.path.abspath(
+            output_directory + filename + '_posterior.npy')
+        jet.Create_Posterior(posterior['path'], len(S), posterior['draws'])
+    metrics.start_stage('MCMC2')
     try:
-        jet.MCMC2_Parallel(S, ETA, THETA, output_directory, filename)
+        mcmc2 = jet.MCMC2_Parallel(S, ETA, THETA, mcmc1, jobs=jobs,
+            checkpoint=checkpoint, queue=args.queue, adaptive=adaptive,
+            seed=seed, metrics=metrics, posterior=posterior, warm=warm)
     except Exception as e:
-        write_log(log_filename, 'critical', 'MCMC2_Parallel failed:', args.debug)
-        write_log(log_filename, 'critical', e, args.debug)
+        log.critical('MCMC2_Parallel failed: %s', e)
         os.sys.exit()
     else:
-        write_log(log_filename, 'info', 'MCMC2_Parallel passed', args.debug)
+        log.info('MCMC2_Parallel passed')
+        log.info('MCMC2 steps per sample: %s', summarize(mcmc2['steps']))
+    metrics.end_stage()
+
+    if samples is not None:
+        metrics.start_stage('refine')
+        try:
+            mcmc2 = jet.Refine_Parallel(S, ETA, THETA, mcmc2, jobs=jobs,
+                checkpoint=checkpoint, queue=args.queue, adaptive=adaptive,
+                seed=seed, warm=warm, metrics=metrics, posterior=posterior,
+                mcmc1=mcmc1)
+        except Exception as e:
+            log.critical('Refine_Parallel failed: %s', e)
+            os.sys.exit()
+        else:
+            log.info('Refine_Parallel passed')
+            log.info('MCMC steps per sample: %s', summarize(mcmc2['steps']))
+        metrics.end_stage()
+    JetCurryResults.append_table(results_path, 'MCMC2', mcmc2)
 
     # Run Simulated Annealing to guarantee Real Solution
+    metrics.start_stage('ANNE1')
     try:
-        jet.Annealing1_Parallel(S, ETA, THETA, output_directory, filename)
+        anne1 = jet.Annealing1_Parallel(S, ETA, THETA, mcmc2, jobs=jobs,
+            checkpoint=checkpoint, queue=args.queue, metrics=metrics)
     except Exception as e:
-        write_log(log_filename, 'critical', 'Annealing1_Parallel failed:', args.debug)
-        write_log(log_filename, 'critical', e, args.debug)
+        log.critical('Annealing1_Parallel failed: %s', e)
         os.sys.exit()
     else:
-        write_log(log_filename, 'info', 'Annealing1_Parallel passed', args.debug)
+        log.info('Annealing1_Parallel passed')
+        JetCurryResults.append_table(results_path, 'ANNE1', anne1)
+    metrics.end_stage()
 
+    metrics.start_stage('ANNE2')
     try:
-        jet.Annealing2_Parallel(S, ETA, THETA, output_directory, filename)
-    except:
-        write_log(log_filename, 'critical', 'Annealing2_Parallel failed:', args.debug)
-        write_log(log_filename, 'critical', e, args.debug)
+        anne2 = jet.Annealing2_Parallel(S, ETA, THETA, anne1, jobs=jobs,
+            checkpoint=checkpoint, queue=args.queue, metrics=metrics)
+    except Exception as e:
+        log.critical('Annealing2_Parallel failed: %s', e)
         os.sys.exit()
     else:
-        write_log(log_filename, 'info', 'Annealing2_Parallel passed', args.debug)
+        log.info('Annealing2_Parallel passed')
+        JetCurryResults.append_table(results_path, 'ANNE2', anne2)
+    metrics.end_stage()
 
+    metrics.start_stage('cartesian')
     try:
         x_coordinates, y_coordinates, z_coordinates = jet.Convert_Results_Cartesian(
-            S, ETA, THETA, output_directory, filename)
+            anne2, ETA)
     except Exception as e:
-        write_log(log_filename, 'critical', 'Failed to convert cartesian coordinates:', args.debug)
-        write_log(log_filename, 'critical', e, args.debug)
+        log.critical('Failed to convert cartesian coordinates: %s', e)
         os.sys.exit()
     else:
-        write_log(log_filename, 'info', 'x coordinates:', args.debug)
-        write_log(log_filename, 'info', str(x_coordinates) + '\n', args.debug)
-        write_log(log_filename, 'info', 'y coordinates:', args.debug)
-        write_log(log_filename, 'info', str(y_coordinates) + '\n', args.debug)
-        write_log(log_filename, 'info', 'z coordinates:', args.debug)
-        write_log(log_filename, 'info', str(z_coordinates) + '\n', args.debug)
-
-    # Plot the Results on Image
-    plt.scatter(x_coordinates, y_coordinates, c='y')
-    plt.scatter(x_smooth, y_smooth, c='r')
-    ax = plt.gca()
-    ax.invert_yaxis()
-    # plt.show()
-    plt.savefig(output_directory + filename + '_sim.png')
-    plt.clf()
-
-    write_log(log_filename, 'info', 'Jet Curry successful for ' + filename + '.fits' + '\n', args.debug)
+        log.info('x coordinates: %s', summarize(x_coordinates))
+        log.info('y coordinates: %s', summarize(y_coordinates))
+        log.info('z coordinates: %s', summarize(z_coordinates))
+        JetCurryResults.append_cartesian(
+            results_path, x_coordinates, y_coordinates, z_coordinates)
+
+    if posterior is not None:
+        try:
+            bands = jet.Convert_Results_Cartesian(
+                np.load(posterior['path'], mmap_mode='r'), ETA)
+        except Exception as e:
+            log.critical('Failed to convert the posterior draws: %s', e)
+            os.sys.exit()
+        else:
+            for name, band in zip('xyz', bands):
+                log.info('%s 16-84 percentile width: %s', name,
+                         summarize(band[2] - band[0]))
+            JetCurryResults.append_bands(results_path, bands,
+                                         jet.PERCENTILES)
+    metrics.end_stage()
+
+    # The text files of earlier versions are only an optional export
+    metrics.start_stage('write')
+    if args.text:
+        JetCurryResults.export_text(results_path, output_directory, filename)
+    metrics.end_stage()
+
+    # The figures are drawn from the results file while the next file
+    # runs, see JetCurryPlots.py
+    if not args.no_plots:
+        JetCurryPlots.plot_in_background(results_path, output_directory,
+                                         filename, dpi=args.plot_dpi)
+        log.info('Plotting %s_contour.png and %s_sim.png in the background',
+                 filename, filename)
+
+    metrics.write(output_directory + filename)
+    log.info('Metrics written to %s_metrics.json', output_directory + filename)
+    log.info('Jet Curry successful for %s.fits\n', filename)
+    close_log(log_filename)
+    return output_directory, metrics.stage_times()
+
+
+def process_file_worker(job):
+    '''
+    Runs process_file in a file-level worker process. A failed file is
+    reported instead of stopping the other files.
+    '''
+    try:
+        process_file(*job)
+    except (Exception, SystemExit) as e:
+        print('Jet Curry failed for %s: %s' % (job[0], e))
+    finally:
+        report_plots()
+        # Worker processes exit without running atexit, so the log of
+        # a failed file is flushed here
+        close_all_logs()
+
+
+def report_plots():
+    '''
+    Waits for the background plots and reports those that failed
+    '''
+    for path in JetCurryPlots.wait_for_plots():
+        print('Plotting failed for %s' % path)
+
+
+def main():
+    args = parse_arguments()
+    files = find_files(args.input, args.jobs)
+
+    # Create output directory if it doesn't exitst
+    if args.out_dir is not None:
+        if not os.path.exists(args.out_dir):
+            try:
+                os.makedirs(args.out_dir)
+            except BaseException:
+                print('%s does not exist and cannot be created' % args.out_dir)
+    else:
+        args.out_dir = os.getcwd()
+
+    if args.out_dir[-1] == '/':
+        output_directory_default = args.out_dir
+    else:
+        output_directory_default = args.out_dir + '/'
+
+    targets = None
+    if args.targets is not None:
+        try:
+            targets = JetCurryTargets.read_targets(args.targets)
+        except Exception as e:
+            print('Cannot read targets file %s: %s' % (args.targets, e))
+            os.sys.exit()
+
+    # Select the bounds of every file first, so that the GUI (if used)
+    # is never waiting on a file that is being processed
+    selections = []
+    for file in files:
+        bounds = select_bounds(file, args, targets)
+        if bounds is None:
+            print('%s is not in the targets file, skipping' % file)
+            continue
+        if (not np.any(bounds[0]) or not np.any(bounds[1])):
+            print('Please select upstream and downstream bounds')
+            os.sys.exit()
+        selections.append((file, bounds[0], bounds[1]))
+
+    # Files are independent. The -jobs worker processes are split
+    # between the files that run at the same time.
+    file_jobs = max(1, min(args.file_jobs, len(selections)))
+    stage_jobs = max(1, args.jobs // file_jobs)
+    jobs = [(file, upstream_bounds, downstream_bounds,
+             output_directory_default, args, stage_jobs)
+            for file, upstream_bounds, downstream_bounds in selections]
+    if file_jobs == 1:
+        for job in jobs:
+            process_file(*job)
+        report_plots()
+    else:
+        with ProcessPoolExecutor(max_workers=file_jobs) as executor:
+            list(executor.map(process_file_worker, jobs))
+
+
+if __name__ == "__main__":
+    main()
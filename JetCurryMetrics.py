@@ -0,0 +1,185 @@
+'''
+Run metrics of the Jet Curry pipeline.
+
+RunMetrics records the wall and CPU time of every stage of a file and,
+for the per-sample solver stages, one row per task with the numbers
+measured by JetCurry.Run_Measured in the worker that ran it. The
+metrics are written as <filename>_metrics.json (stage summaries and
+every task) and <filename>_metrics.csv (one line per task) next to the
+logfile, and with profiling enabled as one <filename>_<stage>.prof
+cProfile dump per stage, merged over all workers.
+'''
+import os
+import sys
+import csv
+import json
+import time
+import pstats
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Columns of the per-task CSV file
+TASK_FIELDS = ('stage', 'index', 'samples', 'wall', 'cpu', 'evaluations',
+               'acceptance', 'iterations', 'peak_rss_mb', 'pid')
+
+
+def peak_rss_mb():
+    '''
+    Peak resident memory of this process in MB, or None if unknown
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / 1048576.0
+    return peak / 1024.0
+
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class _Profile():
+    '''
+    cProfile statistics returned by a worker, in the form pstats.Stats
+    loads from a profiler
+    '''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class RunMetrics():
+    '''
+    Metrics of one FITS file
+
+    Arguments:
+        profile : bool
+            Ask the workers for cProfile statistics of every task
+        progress : bool
+            Show a progress line with throughput and ETA on stderr
+            while the tasks of a stage run
+    '''
+
+    def __init__(self, profile=False, progress=False):
+        self.profile = profile
+        self.progress = progress
+        self.stages = {}
+        self.tasks = []
+        self.profiles = {}
+        self._stage = None
+
+    def start_stage(self, name):
+        '''
+        Starts timing stage name
+        '''
+        self._stage = name
+        self._pid = os.getpid()
+        self._start = time.time()
+        self._start_cpu = time.process_time()
+        self._worker_cpu = 0.0
+        self.stages[name] = {'wall': 0.0, 'cpu': 0.0, 'tasks': 0,
+                             'cached': 0, 'samples': 0, 'evaluations': 0}
+
+    def start_tasks(self, total, cached):
+        '''
+        Called by JetCurry.Run_Parallel before the tasks of the current
+        stage start. cached of the total tasks came from checkpoints.
+        '''
+        stage = self.stages[self._stage]
+        stage['tasks'] = total
+        stage['cached'] = cached
+        self._done = cached
+        self._new_samples = 0
+        self._tasks_start = time.time()
+
+    def add_task(self, index, metrics):
+        '''
+        Records the metrics of a finished task, see JetCurry.Run_Measured
+        '''
+        metrics = dict(metrics)
+        profile = metrics.pop('profile', None)
+        if profile is not None:
+            stats = pstats.Stats(_Profile(profile))
+            if self._stage in self.profiles:
+                self.profiles[self._stage].add(stats)
+            else:
+                self.profiles[self._stage] = stats
+        metrics['stage'] = self._stage
+        metrics['index'] = index
+        self.tasks.append(metrics)
+
+        stage = self.stages[self._stage]
+        stage['samples'] += metrics['samples']
+        stage['evaluations'] += metrics['evaluations']
+        # CPU time of tasks run in this process is already counted
+        if metrics['pid'] != self._pid:
+            self._worker_cpu += metrics['cpu']
+        self._done += 1
+        self._new_samples += metrics['samples']
+        if self.progress:
+            self._show_progress()
+
+    def _show_progress(self):
+        stage = self.stages[self._stage]
+        elapsed = time.time() - self._tasks_start
+        finished = self._done - stage['cached']
+        remaining = stage['tasks'] - self._done
+        eta = elapsed / finished * remaining if finished else 0.0
+        sys.stderr.write('\r%s %d/%d tasks  %.2f samples/s  ETA %s ' % (
+            self._stage, self._done, stage['tasks'],
+            self._new_samples / max(elapsed, 1e-9), _format_duration(eta)))
+        sys.stderr.flush()
+
+    def end_stage(self):
+        '''
+        Stops timing the current stage
+        '''
+        stage = self.stages[self._stage]
+        stage['wall'] = time.time() - self._start
+        stage['cpu'] = time.process_time() - self._start_cpu + self._worker_cpu
+        if stage['samples']:
+            stage['samples_per_second'] = stage['samples'] / stage['wall']
+        if self.progress and stage['tasks'] > stage['cached']:
+            sys.stderr.write('\n')
+        self._stage = None
+
+    def stage_times(self):
+        '''
+        Wall time of every stage, in seconds
+        '''
+        return dict((name, stage['wall']) for name, stage in self.stages.items())
+
+    def write(self, root):
+        '''
+        Writes root + '_metrics.json', root + '_metrics.csv' and the
+        cProfile dumps root + '_<stage>.prof'
+        '''
+        workers = {}
+        for task in self.tasks:
+            if task['peak_rss_mb'] is not None:
+                workers[task['pid']] = max(workers.get(task['pid'], 0),
+                                           task['peak_rss_mb'])
+        for name, stats in self.profiles.items():
+            stats.dump_stats(root + '_' + name + '.prof')
+            self.stages[name]['profile'] = root + '_' + name + '.prof'
+
+        with open(root + '_metrics.json', 'w') as file:
+            json.dump({'stages': self.stages,
+                       'peak_rss_mb': peak_rss_mb(),
+                       'worker_peak_rss_mb': dict(
+                           (str(pid), rss) for pid, rss in workers.items()),
+                       'tasks': self.tasks}, file, indent=1, sort_keys=True)
+        with open(root + '_metrics.csv', 'w') as file:
+            writer = csv.DictWriter(file, TASK_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(self.tasks)
@@ -0,0 +1,212 @@
+'''
+Jet geometry objective shared by the MCMC and annealing stages.
+
+The objective is the sum of the five squared residuals of the jet
+geometry equations for one sample point (s, eta) seen at the line of
+sight angle theta. Everything that only depends on the sample point is
+computed once by Sample_Constants and passed to every evaluation.
+
+If Numba is installed the kernels are JIT compiled, otherwise the same
+code runs as plain NumPy.
+'''
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Set to False to force the NumPy backend even if Numba is installed
+USE_NUMBA = numba is not None
+
+# Number of objective evaluations in this process, read by
+# JetCurry.Run_Measured
+EVALUATIONS = 0
+
+
+def Sample_Constants(s, eta, theta):
+    '''
+    Precomputes the terms of the objective that are constant for a sample
+
+    Arguments:
+        s : float
+            Projected distance of the sample point from the core
+        eta : float
+            Projected angle of the sample point
+        theta : float
+            Line of sight angle (radians)
+
+    Returns:
+        constants : numpy array
+            [s, s*sin(eta), s*cos(eta), cos(eta)**2, tan(eta),
+             sin(theta), cos(theta)]
+    '''
+    sin_eta, cos_eta = np.sin(eta), np.cos(eta)
+    return np.array([s, s * sin_eta, s * cos_eta, cos_eta**2,
+                     sin_eta / cos_eta, np.sin(theta), np.cos(theta)],
+                    dtype=float)
+
+
+def _Value(alpha, beta, phi, xi, d,
+           s, s_sin_eta, s_cos_eta, cos2_eta, tan_eta, sin_theta, cos_theta):
+    '''
+    Objective for scalars or broadcastable arrays of parameters
+    '''
+    sin_alpha, cos_alpha = np.sin(alpha), np.cos(alpha)
+    sin_phi, cos_phi = np.sin(phi), np.cos(phi)
+    sin_xi, cos_xi = np.sin(xi), np.cos(xi)
+    tan_alpha = sin_alpha / cos_alpha
+    cos_beta = np.cos(beta)
+
+    w = s_sin_eta / sin_phi
+    u = s_cos_eta * (sin_theta + cos_theta * tan_alpha)
+    A = w**2 + u**2 - d**2
+    B = (np.tan(beta) / tan_alpha)**2 - cos2_eta
+    C = (d * cos_xi * cos_theta - s_cos_eta * tan_alpha -
+         d * sin_xi * cos_phi * sin_theta)
+    D = tan_eta - (sin_xi * sin_phi) / (cos_xi * sin_theta +
+                                         sin_xi * cos_phi * cos_theta)
+    E = s - d * cos_beta
+    return A**2 + B**2 + C**2 + D**2 + E**2
+
+
+def _Value_And_Gradient(alpha, beta, phi, xi, d,
+                        s, s_sin_eta, s_cos_eta, cos2_eta, tan_eta,
+                        sin_theta, cos_theta):
+    '''
+    Objective and its five partial derivatives for scalar parameters
+    '''
+    sin_alpha, cos_alpha = np.sin(alpha), np.cos(alpha)
+    sin_beta, cos_beta = np.sin(beta), np.cos(beta)
+    sin_phi, cos_phi = np.sin(phi), np.cos(phi)
+    sin_xi, cos_xi = np.sin(xi), np.cos(xi)
+    tan_alpha = sin_alpha / cos_alpha
+    tan_beta = sin_beta / cos_beta
+
+    # Residuals
+    w = s_sin_eta / sin_phi
+    u = s_cos_eta * (sin_theta + cos_theta * tan_alpha)
+    A = w**2 + u**2 - d**2
+    r = tan_beta / tan_alpha
+    B = r**2 - cos2_eta
+    C = (d * cos_xi * cos_theta - s_cos_eta * tan_alpha -
+         d * sin_xi * cos_phi * sin_theta)
+    N = sin_xi * sin_phi
+    M = cos_xi * sin_theta + sin_xi * cos_phi * cos_theta
+    D = tan_eta - N / M
+    E = s - d * cos_beta
+    f = A**2 + B**2 + C**2 + D**2 + E**2
+
+    # Chain rule through the residuals
+    sec2_alpha = 1.0 / cos_alpha**2
+    g_alpha = 2 * (A * 2 * u * s_cos_eta * cos_theta * sec2_alpha -
+                   B * 2 * r * tan_beta / sin_alpha**2 -
+                   C * s_cos_eta * sec2_alpha)
+    g_beta = 2 * (B * 2 * r / (cos_beta**2 * tan_alpha) +
+                  E * d * sin_beta)
+    g_phi = 2 * (-A * 2 * w**2 * cos_phi / sin_phi +
+                 C * d * sin_xi * sin_phi * sin_theta -
+                 D * (sin_xi * cos_phi * M +
+                      N * sin_xi * sin_phi * cos_theta) / M**2)
+    g_xi = 2 * (-C * d * (sin_xi * cos_theta + cos_xi * cos_phi * sin_theta) -
+                D * (cos_xi * sin_phi * M -
+                     N * (cos_xi * cos_phi * cos_theta -
+                          sin_xi * sin_theta)) / M**2)
+    g_d = 2 * (-A * 2 * d +
+               C * (cos_xi * cos_theta - sin_xi * cos_phi * sin_theta) -
+               E * cos_beta)
+    return f, g_alpha, g_beta, g_phi, g_xi, g_d
+
+
+if numba is not None:
+    # Explicit signatures compile (or load from cache) at import time, so
+    # forked worker processes inherit the machine code instead of each
+    # compiling it again
+    _SCALARS = ', '.join(['float64'] * 12)
+    _Value_Jit = numba.njit('float64(' + _SCALARS + ')', cache=True,
+                            error_model='numpy')(_Value)
+    _Value_And_Gradient_Jit = numba.njit(
+        'UniTuple(float64, 6)(' + _SCALARS + ')', cache=True,
+        error_model='numpy')(_Value_And_Gradient)
+
+    @numba.njit('void(float64[:, ::1], float64[::1], float64[::1])',
+                cache=True, error_model='numpy')
+    def _Value_Rows_Jit(v, c, out):
+        for i in range(v.shape[0]):
+            out[i] = _Value_Jit(v[i, 0], v[i, 1], v[i, 2], v[i, 3], v[i, 4],
+                                c[0], c[1], c[2], c[3], c[4], c[5], c[6])
+
+
+def Objective(v, constants):
+    '''
+    Evaluates the objective
+
+    Arguments:
+        v : numpy array
+            [alpha, beta, phi, xi, d] vector, or an (n, 5) array of them
+        constants : numpy array
+            Output of Sample_Constants
+
+    Returns:
+        float or numpy array
+            Objective of each vector
+    '''
+    global EVALUATIONS
+    v = np.asarray(v, dtype=float)
+    EVALUATIONS += v.size // v.shape[-1]
+    if USE_NUMBA and v.ndim == 2:
+        out = np.empty(v.shape[0])
+        _Value_Rows_Jit(np.ascontiguousarray(v), constants, out)
+        return out
+    return _Value(*(tuple(np.moveaxis(v, -1, 0)) + tuple(constants)))
+
+
+def Objective_And_Gradient(x, constants):
+    '''
+    Objective and analytic gradient of a single vector, in the form
+    fmin_l_bfgs_b expects when approx_grad is False
+
+    Arguments:
+        x : numpy array
+            [alpha, beta, phi, xi, d] vector
+        constants : numpy array
+            Output of Sample_Constants
+
+    Returns:
+        f : float
+            Objective
+        g : numpy array
+            Gradient of f with respect to x
+    '''
+    global EVALUATIONS
+    EVALUATIONS += 1
+    arguments = tuple(float(value) for value in x) + tuple(constants)
+    if USE_NUMBA:
+        result = _Value_And_Gradient_Jit(*arguments)
+    else:
+        result = _Value_And_Gradient(*arguments)
+    return result[0], np.array(result[1:])
+
+
+def Log_Probability(v, constants, lower, upper):
+    '''
+    Log-probability of a whole walker ensemble, for emcee's vectorized
+    mode. Walkers outside the open prior box (lower, upper) get -inf
+    and are not evaluated.
+
+    Arguments:
+        v : numpy array
+            (nwalkers, 5) walker positions
+        constants : numpy array
+            Output of Sample_Constants
+        lower, upper : numpy array
+            Prior box
+
+    Returns:
+        lp : numpy array
+            Log-probability of each walker
+    '''
+    inside = np.all((v > lower) & (v < upper), axis=1)
+    lp = np.full(len(v), -np.inf)
+    lp[inside] = -np.log(np.abs(Objective(v[inside], constants)) + 1)
+    return lp
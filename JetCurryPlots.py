@@ -0,0 +1,231 @@
+'''
+Plots of a Jet Curry run, drawn from its results file.
+
+The pipeline does not plot while it solves. Once the results file of a
+FITS file is complete, plot_in_background draws the figures in a
+separate process, so that the next file does not wait for them:
+
+    <filename>_contour.png  contours of the square root scaled image
+                            around the jet, with the ridge and the
+                            smoothed ridge
+    <filename>_sim.png      projected Cartesian coordinates and the
+                            smoothed ridge
+
+Only the region around the bounds is read from the image. Figures are
+drawn on their own matplotlib Figure, never through the pyplot state.
+They can be drawn again, e.g. at another resolution, without running
+the pipeline:
+
+    python JetCurryPlots.py KnotD_Radio_results.fits -dpi 200
+'''
+import os
+import sys
+import argparse
+import multiprocessing
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import JetCurryFits
+import JetCurryResults
+
+# Resolution of the figures, and pixels of image shown around the jet
+DPI = 100
+PADDING = 10
+
+# Plot processes started by plot_in_background
+_background = []
+
+
+def plot_region(header, ridge_y, shape, padding=PADDING):
+    '''
+    Pixel range of the image around the jet
+
+    Arguments:
+        header : astropy.io.fits.Header
+            Primary header of a results file
+        ridge_y : numpy array
+            Rows of the ridge, NaN for columns without data
+        shape : tuple
+            (ny, nx) shape of the image
+        padding : int
+            Pixels added on every side
+
+    Returns:
+        rows, columns : tuple
+            (start, stop) pixel range along y and x
+    '''
+    y = [header['UP_Y'], header['DOWN_Y']]
+    y.extend(ridge_y[np.isfinite(ridge_y)])
+    return JetCurryFits.bounding_box(
+        shape, [header['UP_X'], header['DOWN_X']], y, padding)
+
+
+def _save(figure, path, dpi):
+    FigureCanvasAgg(figure)
+    figure.savefig(path, dpi=dpi)
+
+
+def plot_contour(image, rows, columns, ridge, parameters, path, dpi=DPI):
+    '''
+    Contours of the square root scaled image with the ridge
+
+    Arguments:
+        image : numpy array
+            Image of the region rows, columns
+        rows, columns : tuple
+            (start, stop) pixel range of image
+        ridge, parameters : numpy structured array
+            RIDGE and PARAMETERS tables of a results file
+        path : string
+            PNG file
+        dpi : int
+            Resolution
+    '''
+    # Imported here so that reading results does not need JetCurry
+    import JetCurry as jet
+    data = jet.imagesqrt(image, np.nanmin(image), np.nanmax(image))
+    figure = Figure()
+    axes = figure.add_subplot(111)
+    axes.imshow(data, extent=(columns[0] - 0.5, columns[1] - 0.5,
+                              rows[1] - 0.5, rows[0] - 0.5))
+    axes.contour(np.arange(*columns), np.arange(*rows), data, 10, cmap='gray')
+    axes.scatter(parameters['x_smooth'], parameters['y_smooth'], c='b')
+    axes.scatter(ridge['x'], ridge['y'], c='b')
+    axes.set_title('Outline of Jet Stream')
+    axes.invert_yaxis()
+    _save(figure, path, dpi)
+
+
+def plot_sim(cartesian, parameters, path, dpi=DPI):
+    '''
+    Projected Cartesian coordinates and the smoothed ridge
+
+    Arguments:
+        cartesian, parameters : numpy structured array
+            CARTESIAN and PARAMETERS tables of a results file
+        path : string
+            PNG file
+        dpi : int
+            Resolution
+    '''
+    figure = Figure()
+    axes = figure.add_subplot(111)
+    axes.scatter(cartesian['x'], cartesian['y'], c='y')
+    axes.scatter(parameters['x_smooth'], parameters['y_smooth'], c='r')
+    axes.invert_yaxis()
+    _save(figure, path, dpi)
+
+
+def plot_results(results_path, output_directory=None, filename=None,
+                 fits_path=None, dpi=DPI, padding=PADDING):
+    '''
+    Draws the figures of a results file. Figures whose tables are not in
+    the file yet are skipped.
+
+    Arguments:
+        results_path : string
+            <filename>_results.fits
+        output_directory : string
+            Directory of the figures, by default that of the results file
+        filename : string
+            Prefix of the figures, by default taken from the results file
+        fits_path : string
+            Input FITS file, by default the one stored in the results file
+        dpi : int
+            Resolution of the figures
+        padding : int
+            Pixels of image shown around the jet
+    '''
+    if output_directory is None:
+        output_directory = os.path.join(os.path.dirname(results_path), '')
+    if filename is None:
+        filename = os.path.basename(results_path)
+        if filename.endswith('_results.fits'):
+            filename = filename[:-len('_results.fits')]
+    root = output_directory + filename
+
+    with JetCurryResults.read_results(results_path) as results:
+        header = results[0].header
+        names = [hdu.name for hdu in results]
+        if 'PARAMETERS' not in names:
+            return
+        parameters = np.array(results['PARAMETERS'].data)
+        if 'RIDGE' in names:
+            ridge = np.array(results['RIDGE'].data)
+            if fits_path is None:
+                fits_path = header.get('INPUT')
+            if fits_path is None or not os.path.exists(fits_path):
+                raise IOError('input FITS file of %s not found: %s' %
+                              (results_path, fits_path))
+            rows, columns = plot_region(
+                header, ridge['y'], JetCurryFits.image_shape(fits_path), padding)
+            image = JetCurryFits.load_fits_section(fits_path, rows, columns)
+            plot_contour(image, rows, columns, ridge, parameters,
+                         root + '_contour.png', dpi)
+        if 'CARTESIAN' in names:
+            plot_sim(np.array(results['CARTESIAN'].data), parameters,
+                     root + '_sim.png', dpi)
+
+
+def plot_in_background(results_path, output_directory=None, filename=None,
+                       dpi=DPI, padding=PADDING):
+    '''
+    Starts plot_results in a separate process. wait_for_plots waits for
+    every process started this way.
+    '''
+    process = multiprocessing.Process(
+        target=plot_results, args=(results_path, output_directory, filename),
+        kwargs={'dpi': dpi, 'padding': padding})
+    process.start()
+    _background.append((results_path, process))
+
+
+def wait_for_plots():
+    '''
+    Waits for the plot processes of plot_in_background
+
+    Returns:
+        list
+            Results files whose plots failed
+    '''
+    failed = []
+    while _background:
+        results_path, process = _background.pop(0)
+        process.join()
+        if process.exitcode != 0:
+            failed.append(results_path)
+    return failed
+
+
+def parse_arguments(argv=None):
+    '''
+    Create command line argument parser
+    '''
+    parser = argparse.ArgumentParser(
+        description='Draw the figures of Jet Curry results files')
+    parser.add_argument('results', nargs='+', help='<filename>_results.fits files')
+    parser.add_argument('-fits',
+                        help='input FITS file (default: the one stored in the results file)')
+    parser.add_argument('-dpi', type=int, default=DPI,
+                        help='resolution of the figures (default: %(default)s)')
+    parser.add_argument('-padding', type=int, default=PADDING,
+                        help='pixels of image shown around the jet (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_arguments()
+    failed = False
+    for path in args.results:
+        try:
+            plot_results(path, fits_path=args.fits, dpi=args.dpi,
+                         padding=args.padding)
+        except Exception as e:
+            print('Plotting failed for %s: %s' % (path, e))
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+'''
+Work queue on a shared filesystem for running the per-sample solver
+stages on several machines without a broker service.
+
+A queue is a directory with three subdirectories:
+
+    tasks/     one pickled (function name, arguments, profile) file per
+               sample
+    claimed/   tasks a worker is running. A worker claims a task by
+               renaming it from tasks/ to claimed/<task>.<host>.<pid>,
+               which only one worker can win, and touches the claimed
+               file while the task runs
+    results/   one pickled result, its metrics and its log records per
+               finished task
+
+The coordinator (JetCurry.Run_Parallel with a queue directory) writes
+the tasks, collects the results and puts claimed tasks whose worker
+stopped touching them back into tasks/. Heartbeats are compared with
+the clock of the shared filesystem, not that of the coordinator's
+machine. Once a task is finished its copies that were put back are
+withdrawn, and a worker drops the result of a task that is neither
+claimed by it nor still in the queue. Workers are started with JetCurryWorker.py on any
+machine that mounts the queue directory.
+'''
+import os
+import time
+import uuid
+import pickle
+import socket
+import threading
+import traceback
+import numpy as np
+import JetCurryLogger
+
+TASKS = 'tasks'
+CLAIMED = 'claimed'
+RESULTS = 'results'
+
+# File in the queue root touched to read the filesystem's clock
+CLOCK = '.clock'
+
+# Seconds between touches of a claimed task by its worker, and the age
+# after which the coordinator assumes the worker died (10 missed
+# heartbeats)
+HEARTBEAT = 30.0
+STALE_AFTER = 10 * HEARTBEAT
+
+
+def _make_directories(queue_directory):
+    for name in (TASKS, CLAIMED, RESULTS):
+        path = os.path.join(queue_directory, name)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(path):
+                    raise
+
+
+def _write_atomic(path, value, queue_directory):
+    '''
+    Pickles value to a temporary file in the queue root and renames it
+    into place, so readers never see a partial file
+    '''
+    temporary = os.path.join(queue_directory, '.%s.%s.%d.tmp' % (
+        os.path.basename(path), socket.gethostname(), os.getpid()))
+    with open(temporary, 'wb') as file:
+        pickle.dump(value, file, protocol=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.rename(temporary, path)
+
+
+def _worker_id():
+    '''
+    Identity of this worker process, <host>.<pid>
+    '''
+    return '%s.%d' % (socket.gethostname(), os.getpid())
+
+
+def _claim_path(queue_directory, name):
+    '''
+    Claimed file of task name held by this worker process
+    '''
+    return os.path.join(queue_directory, CLAIMED,
+                        '%s.%s' % (name, _worker_id()))
+
+
+def _filesystem_time(path):
+    '''
+    Current time of the filesystem holding path, read from the
+    modification time of path after touching it
+    '''
+    with open(path, 'a'):
+        pass
+    os.utime(path, None)
+    return os.path.getmtime(path)
+
+
+def run_tasks(function, jobs, queue_directory, poll_interval=1.0,
+              stale_after=STALE_AFTER, profile=False):
+    '''
+    Submits tasks to the queue and yields results as workers finish them
+
+    Arguments:
+        function : function
+            Module level function of JetCurry, e.g. Run_MCMC1
+        jobs : list of tuples
+            (index, arguments) of each task
+        queue_directory : string
+            Queue directory shared with the workers
+        poll_interval : float
+            Seconds between scans of the results directory
+        stale_after : float
+            Seconds after which a claimed task without a heartbeat is
+            given to another worker
+        profile : bool
+            Ask the workers for cProfile statistics of every task
+
+    Yields:
+        index, result, metrics
+            In the order the tasks finish, see JetCurry.Run_Measured
+    '''
+    _make_directories(queue_directory)
+    run = uuid.uuid4().hex[:12]
+    names = {}
+    for i, arguments in jobs:
+        name = '%s_%s_%06d' % (run, function.__name__, i)
+        names[name] = i
+        _write_atomic(os.path.join(queue_directory, TASKS, name),
+                      (function.__name__, tuple(arguments), profile),
+                      queue_directory)
+
+    pending = set(names)
+    try:
+        while pending:
+            finished = []
+            for name in sorted(pending):
+                path = os.path.join(queue_directory, RESULTS, name)
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'rb') as file:
+                    status, result, records = pickle.load(file)
+                os.remove(path)
+                # Messages of the task go to the log file of the run,
+                # like those of local worker processes
+                JetCurryLogger.replay_worker(records)
+                if status == 'error':
+                    raise RuntimeError('Task %s failed on a worker:\n%s' %
+                                       (name, result))
+                finished.append(name)
+                yield (names[name],) + tuple(result)
+            pending.difference_update(finished)
+            if finished:
+                # A requeued copy of a finished task is not run again
+                _withdraw(queue_directory, finished)
+            elif pending:
+                _requeue_stale(queue_directory, pending, stale_after)
+                time.sleep(poll_interval)
+    finally:
+        # Withdraw whatever is left if the coordinator stops early
+        _withdraw(queue_directory, pending)
+        for name in pending:
+            try:
+                os.remove(os.path.join(queue_directory, RESULTS, name))
+            except OSError:
+                pass
+
+
+def _claims(queue_directory, names):
+    '''
+    Yields (name, path) of the claimed files of the tasks in names
+    '''
+    claimed = os.path.join(queue_directory, CLAIMED)
+    for claim in os.listdir(claimed):
+        name = claim.split('.', 1)[0]
+        if name in names:
+            yield name, os.path.join(claimed, claim)
+
+
+def _withdraw(queue_directory, names):
+    '''
+    Removes the waiting tasks and the claims of names. A worker whose
+    claim was removed drops the result of its task.
+    '''
+    names = set(names)
+    for name in names:
+        try:
+            os.remove(os.path.join(queue_directory, TASKS, name))
+        except OSError:
+            pass
+    for name, path in _claims(queue_directory, names):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _queued(queue_directory, name):
+    '''
+    True if task name is waiting in tasks/ or claimed by any worker
+    '''
+    if os.path.exists(os.path.join(queue_directory, TASKS, name)):
+        return True
+    return any(True for _ in _claims(queue_directory, set([name])))
+
+
+def _requeue_stale(queue_directory, names, stale_after):
+    '''
+    Moves claimed tasks whose worker stopped touching them back to tasks/
+    '''
+    now = _filesystem_time(os.path.join(queue_directory, CLOCK))
+    for name, path in _claims(queue_directory, names):
+        try:
+            if now - os.path.getmtime(path) > stale_after:
+                os.rename(path, os.path.join(queue_directory, TASKS, name))
+        except OSError:
+            # Finished in the meantime
+            pass
+
+
+def _claim_task(queue_directory):
+    '''
+    Claims the oldest waiting task for this worker process, see
+    _claim_path. Returns its name, or None if there are no tasks left
+    to claim
+    '''
+    tasks = os.path.join(queue_directory, TASKS)
+    for name in sorted(os.listdir(tasks)):
+        claimed = _claim_path(queue_directory, name)
+        try:
+            os.rename(os.path.join(tasks, name), claimed)
+        except OSError:
+            # Another worker claimed it first
+            continue
+        # The rename keeps the submission time, start the heartbeat now
+        try:
+            os.utime(claimed, None)
+        except OSError:
+            pass
+        return name
+    return None
+
+
+def _heartbeat(path, stop):
+    while not stop.wait(HEARTBEAT):
+        try:
+            os.utime(path, None)
+        except OSError:
+            return
+
+
+def work(queue_directory, poll_interval=1.0, idle_exit=None):
+    '''
+    Worker loop: claims tasks, runs them and writes their results
+
+    Arguments:
+        queue_directory : string
+            Queue directory shared with the coordinator
+        poll_interval : float
+            Seconds to wait when there is no task to claim
+        idle_exit : float
+            Exit after this many seconds without a task. Runs until
+            killed if None
+    '''
+    import JetCurry
+    _make_directories(queue_directory)
+    # Forked worker processes would otherwise all draw the same random
+    # numbers, see JetCurry._Init_Worker
+    np.random.seed()
+    log = JetCurryLogger.buffer_worker()
+    idle_since = time.time()
+    while True:
+        name = _claim_task(queue_directory)
+        if name is None:
+            if idle_exit is not None and time.time() - idle_since > idle_exit:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        claimed = _claim_path(queue_directory, name)
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(claimed, stop))
+        beat.daemon = True
+        beat.start()
+        del log.records[:]
+        try:
+            with open(claimed, 'rb') as file:
+                function_name, arguments, profile = pickle.load(file)
+            result = ('ok', JetCurry.Run_Measured(
+                getattr(JetCurry, function_name), arguments, profile))
+        except Exception:
+            result = ('error', '%s: %s' % (socket.gethostname(),
+                                           traceback.format_exc()))
+        finally:
+            stop.set()
+            beat.join()
+        # A task that is no longer claimed or waiting anywhere was
+        # finished by another worker, or its coordinator stopped
+        if os.path.exists(claimed) or _queued(queue_directory, name):
+            _write_atomic(os.path.join(queue_directory, RESULTS, name),
+                          result + (log.records,), queue_directory)
+            try:
+                os.remove(claimed)
+            except OSError:
+                pass
+        idle_since = time.time()
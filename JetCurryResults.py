@@ -0,0 +1,189 @@
+'''
+Results container of a Jet Curry run.
+
+All data products of a FITS file are kept in one FITS file,
+<filename>_results.fits, instead of a text file per stage:
+
+    PRIMARY     header with the input file, bounds, line of sight angle
+                and solver settings
+    RIDGE       table of the brightest pixel (x, y, intensity) of every
+                column between the bounds
+    PARAMETERS  table of s, eta, x_smooth and y_smooth per sample
+    MCMC1, MCMC2, ANNE1, ANNE2
+                table of each stage result (index, alpha, beta, phi,
+                xi, d, steps). With -coarse, MCMC1 only has the coarse
+                sample points
+    CARTESIAN   table of x, y, z per sample
+    BANDS       with -posterior, table of percentiles of x, y and z
+                over the posterior draws per sample, e.g. x_16, x_50, x_84
+
+Tables are appended as the pipeline finishes each stage, store every
+value at full precision and are memory-mapped when read, e.g.
+
+    from astropy.io import fits
+    results = fits.open('KnotD_Radio_results.fits', memmap=True)
+    x = results['CARTESIAN'].data['x']
+
+The text files of earlier versions can still be exported, either with
+JetCurryMain.py -text or afterwards with
+
+    python JetCurryResults.py KnotD_Radio_results.fits
+'''
+import os
+import sys
+import json
+import numpy as np
+from astropy.io import fits
+
+STAGES = ('MCMC1', 'MCMC2', 'ANNE1', 'ANNE2')
+
+
+def _table(columns):
+    '''
+    Structured array of float columns given as (name, values) pairs
+    '''
+    table = np.zeros(len(columns[0][1]),
+                     dtype=[(name, float) for name, _ in columns])
+    for name, values in columns:
+        table[name] = values
+    return table
+
+
+def create_results(path, filename, upstream_bounds, downstream_bounds,
+                   theta, settings=None, input_path=None):
+    '''
+    Creates (or replaces) a results container holding only the metadata
+
+    Arguments:
+        path : string
+            Results file
+        filename : string
+            Name of the input FITS file
+        upstream_bounds, downstream_bounds : numpy array
+            Bounds of the jet
+        theta : float
+            Line of sight angle (radians)
+        settings : dict
+            Solver settings, e.g. {'adaptive': None, 'seed': {...}},
+            stored as JSON
+        input_path : string
+            Path of the input FITS file, used to plot the results later
+    '''
+    header = fits.Header()
+    header['FILENAME'] = (filename, 'input FITS file')
+    if input_path is not None:
+        header['INPUT'] = os.path.abspath(input_path)
+    header['UP_X'] = (int(upstream_bounds[0]), 'upstream bound x')
+    header['UP_Y'] = (int(upstream_bounds[1]), 'upstream bound y')
+    header['DOWN_X'] = (int(downstream_bounds[0]), 'downstream bound x')
+    header['DOWN_Y'] = (int(downstream_bounds[1]), 'downstream bound y')
+    header['THETA'] = (float(theta), 'line of sight angle (radians)')
+    header['SETTINGS'] = json.dumps(settings or {}, sort_keys=True)
+    fits.PrimaryHDU(header=header).writeto(path, overwrite=True)
+
+
+def append_table(path, name, table):
+    '''
+    Appends a table HDU to a results container
+
+    Arguments:
+        path : string
+            Results file made by create_results
+        name : string
+            Extension name, e.g. 'MCMC1'
+        table : numpy structured array
+            Rows of the table
+    '''
+    hdu = fits.BinTableHDU(data=np.asarray(table), name=name)
+    fits.append(path, hdu.data, hdu.header)
+
+
+def append_ridge(path, x, y, intensity):
+    '''
+    Appends the RIDGE table
+    '''
+    append_table(path, 'RIDGE', _table(
+        [('x', x), ('y', y), ('intensity', intensity)]))
+
+
+def append_parameters(path, s, eta, x_smooth, y_smooth):
+    '''
+    Appends the PARAMETERS table
+    '''
+    append_table(path, 'PARAMETERS', _table(
+        [('s', s), ('eta', eta), ('x_smooth', x_smooth),
+         ('y_smooth', y_smooth)]))
+
+
+def append_cartesian(path, x, y, z):
+    '''
+    Appends the CARTESIAN table
+    '''
+    append_table(path, 'CARTESIAN', _table([('x', x), ('y', y), ('z', z)]))
+
+
+def append_bands(path, bands, percentiles):
+    '''
+    Appends the BANDS table
+
+    Arguments:
+        bands : tuple
+            x, y and z percentiles, each (len(percentiles), n), as
+            returned by JetCurry.Convert_Results_Cartesian for draws
+        percentiles : sequence of float
+    '''
+    append_table(path, 'BANDS', _table(
+        [('%s_%g' % (name, q), band[k])
+         for name, band in zip('xyz', bands)
+         for k, q in enumerate(percentiles)]))
+
+
+def read_results(path):
+    '''
+    Opens a results container. Table data is memory-mapped.
+
+    Returns:
+        astropy.io.fits.HDUList
+            Index it by extension name, e.g. results['ANNE2'].data
+    '''
+    return fits.open(path, memmap=True)
+
+
+def export_text(path, output_directory, filename):
+    '''
+    Writes the tab separated text files of every table in a results
+    container: <filename>_parameters.txt, <filename>_<stage>.txt and
+    <filename>_Cartesian_Coordinates.txt
+    '''
+    # Imported here so that reading results does not need JetCurry
+    import JetCurry as jet
+    with read_results(path) as results:
+        names = [hdu.name for hdu in results]
+        if 'PARAMETERS' in names:
+            p = results['PARAMETERS'].data
+            jet.Write_Parameters(p['s'], p['eta'], p['x_smooth'],
+                                 p['y_smooth'], output_directory, filename)
+        for stage_name in STAGES:
+            if stage_name in names:
+                jet.Write_Stage_Results(results[stage_name].data,
+                                        output_directory, filename, stage_name)
+        if 'CARTESIAN' in names:
+            c = results['CARTESIAN'].data
+            jet.Write_Cartesian_Coordinates(c['x'], c['y'], c['z'],
+                                            output_directory, filename)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python JetCurryResults.py FILE_results.fits [...]')
+        return
+    for path in sys.argv[1:]:
+        output_directory = os.path.join(os.path.dirname(path), '')
+        filename = os.path.basename(path)
+        if filename.endswith('_results.fits'):
+            filename = filename[:-len('_results.fits')]
+        export_text(path, output_directory, filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+'''
+Upstream and downstream bounds of FITS files for headless runs.
+
+A targets file is either CSV with the header
+
+    filename,upstream_x,upstream_y,downstream_x,downstream_y
+
+or JSON of the form
+
+    {"KnotD_Radio.fits": {"upstream": [10, 18], "downstream": [40, 18]}}
+
+Filenames are matched on the base name, with or without the .fits
+extension, so the same targets file works for any input directory.
+'''
+import os
+import csv
+import json
+import numpy as np
+
+
+def _target_name(file):
+    '''
+    Base name of a file without its extension
+    '''
+    return os.path.splitext(os.path.basename(file))[0]
+
+
+def read_targets(path):
+    '''
+    Reads a CSV or JSON targets file
+
+    Arguments:
+        path : string
+            Targets file. JSON is assumed for a .json extension,
+            CSV otherwise
+
+    Returns:
+        targets : dict
+            (upstream_bounds, downstream_bounds) numpy arrays keyed by
+            the base name of each file
+    '''
+    targets = {}
+    with open(path, 'r') as file:
+        if path.lower().endswith('.json'):
+            for name, bounds in json.load(file).items():
+                targets[_target_name(name)] = (
+                    np.array(bounds['upstream'], dtype=int),
+                    np.array(bounds['downstream'], dtype=int))
+        else:
+            for row in csv.DictReader(file):
+                targets[_target_name(row['filename'].strip())] = (
+                    np.array([row['upstream_x'], row['upstream_y']], dtype=int),
+                    np.array([row['downstream_x'], row['downstream_y']], dtype=int))
+    return targets
+
+
+def lookup_bounds(targets, file):
+    '''
+    Bounds of file in targets, or None if the file is not listed
+    '''
+    return targets.get(_target_name(file))
@@ -0,0 +1,43 @@
+'''
+Worker for the shared-filesystem work queue of JetCurryMain.py -queue
+
+Start any number of these on machines that mount the queue directory:
+
+    python JetCurryWorker.py /shared/queue -jobs 16
+
+Each worker process claims per-sample tasks, runs them and writes the
+results back to the queue, see JetCurryQueue.py.
+'''
+import argparse
+from multiprocessing import Process, cpu_count
+import JetCurryQueue
+
+
+def parse_arguments():
+    '''
+    Create command line argument parser
+    '''
+    parser = argparse.ArgumentParser(description="Jet Curry queue worker")
+    parser.add_argument('queue', help='queue directory shared with JetCurryMain.py -queue')
+    parser.add_argument('-jobs', type=int, default=cpu_count(),
+                        help='number of worker processes on this machine (default: number of cores)')
+    parser.add_argument('-poll', type=float, default=1.0,
+                        help='seconds to wait when the queue is empty')
+    parser.add_argument('-idle_exit', type=float,
+                        help='exit after this many seconds without a task (default: run until killed)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    workers = [Process(target=JetCurryQueue.work,
+                       args=(args.queue, args.poll, args.idle_exit))
+               for _ in range(max(1, args.jobs))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()